@@ -2,11 +2,9 @@
 
 import os
 import sys
+import logging
 import traceback
 import configparser
-from urllib.error import HTTPError
-
-from pysonic.libsonic.connection import Connection
 
 from variables import CONFIG_DIR, CACHE_DIR, MUSIC_CACHE_DIR, LOG_DIR, RUN_DIR
 from variables import CONFIG_FILE
@@ -68,6 +66,12 @@ class Subsonic():
         self.connection = self.connect()
 
     def connect(self):
+        # Imported here, as most client commands never talk to the media
+        # server and py-sonic pulls in all of urllib and http.client.
+        from urllib.error import HTTPError
+        from pysonic.libsonic.connection import Connection
+        from libsonar import keepalive
+
         connection = Connection(
             self.config["media-server"]["host"],
             self.config["media-server"]["user"],
@@ -82,4 +86,32 @@ class Subsonic():
             print("\nMake sure your confs are good.\n")
             sys.exit(0)
 
-        return connection
+        return keepalive.install(connection)
+
+
+def open_stream(connection, song_id, offset=0):
+    """
+    Opens the stream of a song on a py-sonic connection, from byte offset
+    on. py-sonic's stream() can't send headers, so resuming builds the same
+    request with its private helpers, which nothing else uses. Without them
+    (another py-sonic version) the whole song is streamed instead, and the
+    download starts over.
+    """
+    if offset:
+        try:
+            get_request = connection._getRequest
+            do_request = connection._doBinReq
+            check_status = connection._checkStatus
+        except AttributeError:
+            logging.getLogger("sonar-server").warning(
+                "This py-sonic can't resume downloads."
+            )
+        else:
+            request = get_request("stream.view", {"id": song_id})
+            request.add_header("Range", "bytes=%d-" % offset)
+            res = do_request(request)
+            if isinstance(res, dict):
+                check_status(res)
+            return res
+
+    return connection.stream(song_id)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Index of the songs in the music cache.
+
+The index knows the size of every cached song and the order in which they
+were last used, so keeping the cache under its limit does not have to list
+and stat the cache directory. It lives in memory and is persisted as an
+append-only log, which is compacted when it has grown too much. If the log
+is lost or does not match the directory anymore, the index is rebuilt from
+the directory.
+
+Log lines are either `+ <song id> <size>` (added or used, which makes the
+song the most recently used one) or `- <song id>` (removed).
+
+Songs can be pinned, which keeps them from being evicted no matter how long
+ago they were used. Pins are not persisted here; whoever pins songs pins
+them again after a restart.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from libsonar.metrics import metrics
+
+logger = logging.getLogger("sonar-server")
+
+SONG_SUFFIX = ".mp3"
+
+
+class CacheIndex(object):
+    def __init__(self, cache_dir, index_file, limit):
+        self.cache_dir = cache_dir
+        self.index_file = index_file
+        # Max size of the cache in bytes.
+        self.limit = limit
+
+        # song id -> size in bytes, least recently used first.
+        self.entries = OrderedDict()
+        self.size = 0
+        # Ids of the pinned songs, and the size of those that are cached.
+        self.pinned = set()
+        self.pinned_size = 0
+        self.log_lines = 0
+        self.lock = threading.RLock()
+        # Bumped whenever songs are added or removed.
+        self.version = 0
+
+        if not self._load():
+            self.rebuild()
+        self.log = open(self.index_file, "a")
+
+    def _song_path(self, song_id):
+        return os.path.join(self.cache_dir, "%s%s" % (song_id, SONG_SUFFIX))
+
+    def _load(self):
+        try:
+            with open(self.index_file, "rt") as f:
+                for line in f:
+                    self.log_lines += 1
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0] == "+":
+                        self._set(parts[1], int(parts[2]))
+                    elif len(parts) == 2 and parts[0] == "-":
+                        self._unset(parts[1])
+                    elif parts:
+                        raise ValueError("Bad line: %s" % line)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            logger.warning("Cache index is corrupt (%s)." % e)
+            return False
+
+        # A cheap sanity check. Listing the directory costs no stats.
+        cached = sum(
+            1 for f in os.listdir(self.cache_dir) if f.endswith(SONG_SUFFIX)
+        )
+        if cached != len(self.entries):
+            logger.warning("Cache index does not match the music cache.")
+            return False
+
+        return True
+
+    def rebuild(self):
+        """
+        Recreates the index from the files in the cache directory, using
+        their mtime as last use.
+        """
+        logger.info("Rebuilding the music cache index.")
+        songs = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(SONG_SUFFIX) and entry.is_file():
+                stat = entry.stat()
+                songs.append((
+                    stat.st_mtime,
+                    entry.name[:-len(SONG_SUFFIX)],
+                    stat.st_size
+                ))
+        songs.sort()
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.pinned_size = 0
+            for _, song_id, size in songs:
+                self._set(song_id, size)
+            self._compact()
+            self.version += 1
+
+    def _compact(self):
+        tmp_file = "%s.tmp" % self.index_file
+        with open(tmp_file, "wt") as f:
+            for song_id, size in self.entries.items():
+                f.write("+ %s %d\n" % (song_id, size))
+        os.replace(tmp_file, self.index_file)
+        self.log_lines = len(self.entries)
+
+        if getattr(self, "log", None):
+            self.log.close()
+            self.log = open(self.index_file, "a")
+
+    def _append(self, line):
+        self.log.write(line)
+        self.log.flush()
+        self.log_lines += 1
+        if self.log_lines > 2 * len(self.entries) + 1000:
+            self._compact()
+
+    def _set(self, song_id, size):
+        self._unset(song_id)
+        self.entries[song_id] = size
+        self.size += size
+        if song_id in self.pinned:
+            self.pinned_size += size
+
+    def _unset(self, song_id):
+        size = self.entries.pop(song_id, None)
+        if size is not None:
+            self.size -= size
+            if song_id in self.pinned:
+                self.pinned_size -= size
+        return size
+
+    def __contains__(self, song_id):
+        return str(song_id) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, song_id, size):
+        song_id = str(song_id)
+        with self.lock:
+            self._set(song_id, size)
+            self._append("+ %s %d\n" % (song_id, size))
+            self.version += 1
+
+    def touch(self, song_id):
+        """
+        Marks a song as the most recently used one. Returns False if the
+        song is not in the cache.
+        """
+        song_id = str(song_id)
+        with self.lock:
+            if song_id not in self.entries:
+                return False
+            self.entries.move_to_end(song_id)
+            self._append("+ %s %d\n" % (song_id, self.entries[song_id]))
+        return True
+
+    def remove(self, song_id):
+        song_id = str(song_id)
+        with self.lock:
+            if self._unset(song_id) is not None:
+                self._append("- %s\n" % song_id)
+                self.version += 1
+
+        try:
+            os.remove(self._song_path(song_id))
+        except FileNotFoundError:
+            pass
+
+    def pin(self, song_ids):
+        """
+        Keeps songs from being evicted. Songs that are not cached yet are
+        pinned once they are added.
+        """
+        with self.lock:
+            for song_id in map(str, song_ids):
+                if song_id not in self.pinned:
+                    self.pinned.add(song_id)
+                    self.pinned_size += self.entries.get(song_id, 0)
+
+    def unpin(self, song_ids):
+        with self.lock:
+            for song_id in map(str, song_ids):
+                if song_id in self.pinned:
+                    self.pinned.remove(song_id)
+                    self.pinned_size -= self.entries.get(song_id, 0)
+
+    def evict(self, limit):
+        """
+        Removes least recently used songs that are not pinned until the cache
+        is no larger than limit bytes. Returns the ids of the removed songs.
+        """
+        evicted = []
+        with self.lock:
+            for song_id in list(self.entries):
+                if self.size <= limit:
+                    break
+                if song_id not in self.pinned:
+                    self.remove(song_id)
+                    evicted.append(song_id)
+            if self.size > limit:
+                logger.warning("Pinned songs don't fit in the cache limit.")
+        if evicted:
+            metrics.inc("sonar_music_cache_evictions_total", len(evicted))
+        return evicted
+
+    def enforce_limit(self):
+        if self.size > self.limit:
+            logger.info("Enforcing cache limit of %d Mb" % (self.limit >> 20))
+            return self.evict(self.limit)
+        return []
+
+    def close(self):
+        with self.lock:
+            self.log.close()
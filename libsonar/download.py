@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+"""
+Song downloads into the music cache.
+
+A download is written in fixed size chunks to a `.part` file next to its
+final path and renamed into place once it is complete, so the cache never
+contains half written songs. Other threads can wait for a number of bytes
+to arrive, which is what allows playback to start before the download is
+done.
+
+A download that breaks off keeps its `.part` file, along with a sidecar
+recording the size the media server gave for the song. The next download
+of the song continues where it stopped with a Range request, if the song
+still has that size and the server honours the range. Transcoded streams
+don't have the size of the song and always start over.
+"""
+
+import os
+import json
+import time
+import errno
+import threading
+
+from libsonar.metrics import metrics
+
+CHUNK_SIZE = 64 << 10
+
+# Partial downloads nobody came back for are removed after this many
+# seconds, see remove_stale_parts().
+PART_MAX_AGE = 7 * 86400
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class Download(object):
+    def __init__(self, song_id, path, prefetch=False, limiter=None, size=None):
+        self.song_id = song_id
+        self.path = path
+        self.part_path = "%s.part" % path
+        self.meta_path = "%s.json" % self.part_path
+
+        # Size of the song according to the media server, if known.
+        self.size = size
+        # Whether the .part file is worth keeping if the download fails.
+        self.resumable = False
+
+        # Prefetches are throttled and can be cancelled, until someone
+        # claims the download because they actually need the song. A
+        # download nobody needs anymore is cancelled, see release().
+        self.limiter = limiter
+        self.claims = 0 if prefetch else 1
+        self.cancelled = False
+
+        self.received = 0
+        self.total = None
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        # (size, callback) pairs waiting for data, see when().
+        self.callbacks = []
+
+    def resume_offset(self):
+        """
+        Returns the number of bytes an interrupted download of the song left
+        on disk, or 0 if there is nothing to resume. Partial files that
+        can't be resumed are removed.
+        """
+        try:
+            with open(self.meta_path, "rt") as f:
+                expected = json.load(f).get("size")
+            offset = os.path.getsize(self.part_path)
+        except (OSError, ValueError, AttributeError):
+            expected = offset = None
+
+        if self.size and expected == self.size and 0 < offset < self.size:
+            self.resumable = True
+            return offset
+
+        self._discard()
+        return 0
+
+    def run(self, stream, offset=0):
+        """
+        Copies the stream into the cache, appending to the first offset
+        bytes of the song if they are already on disk. Memory use is one
+        chunk no matter how big the song is. The caller marks the download
+        as finished.
+        """
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        start = time.perf_counter()
+        try:
+            if offset and not self._is_rest(stream, offset):
+                # The server ignored the Range header and sends it all.
+                offset = 0
+
+            # Content-Length of the response, if the server sent one.
+            length = getattr(stream, "length", None)
+            self.total = offset + length if length is not None else None
+            if not offset:
+                self._start(length)
+            self._advance(offset)
+
+            with open(self.part_path, "ab" if offset else "wb") as f:
+                while True:
+                    if self.cancelled:
+                        raise DownloadCancelled(self.song_id)
+                    size = stream.readinto(buf)
+                    if not size:
+                        break
+                    if self.limiter and not self.claimed:
+                        self.limiter.consume(size)
+                    f.write(view[:size])
+                    # Make the chunk visible to readers tailing the file.
+                    f.flush()
+                    self._advance(size)
+                    metrics.inc("sonar_download_bytes_total", size)
+
+            if self.total is not None and self.received < self.total:
+                raise IOError("Download ended after %d of %d bytes." % (
+                    self.received, self.total
+                ))
+            os.replace(self.part_path, self.path)
+            self._remove(self.meta_path)
+        except Exception:
+            if not self.resumable:
+                self._discard()
+            raise
+        finally:
+            stream.close()
+            # Throughput is bytes over seconds spent downloading.
+            metrics.inc(
+                "sonar_download_seconds_total", time.perf_counter() - start
+            )
+
+    def _is_rest(self, stream, offset):
+        headers = getattr(stream, "headers", None) or {}
+        return getattr(stream, "status", None) == 206 and \
+            headers.get("Content-Range", "").startswith("bytes %d-" % offset)
+
+    def _start(self, length):
+        """
+        Records the size of the song for a later resume, unless the stream
+        isn't the song as the media server knows it.
+        """
+        self.resumable = bool(self.size) and length == self.size
+        if self.resumable:
+            with open(self.meta_path, "wt") as f:
+                json.dump({"size": self.size}, f)
+        else:
+            self._remove(self.meta_path)
+
+    def _discard(self):
+        self.resumable = False
+        self._remove(self.part_path)
+        self._remove(self.meta_path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _advance(self, size):
+        with self.condition:
+            self.received += size
+            self.condition.notify_all()
+            ready = self._ready_callbacks()
+        for callback in ready:
+            callback()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+            ready = self._ready_callbacks()
+        for callback in ready:
+            callback()
+
+    def _arrived(self, size):
+        return self.done or (size is not None and self.received >= size)
+
+    def _ready_callbacks(self):
+        """
+        Removes and returns the callbacks whose data arrived. Called with
+        the condition held.
+        """
+        if not self.callbacks:
+            return []
+        ready = [c for size, c in self.callbacks if self._arrived(size)]
+        self.callbacks = [
+            (size, c) for size, c in self.callbacks if not self._arrived(size)
+        ]
+        return ready
+
+    @property
+    def claimed(self):
+        return self.claims > 0
+
+    def claim(self):
+        self.claims += 1
+        self.cancelled = False
+
+    def release(self):
+        """
+        Gives up a claim. Cancels the download if that was the last one.
+        """
+        self.claims = max(self.claims - 1, 0)
+        self.cancel()
+
+    def cancel(self):
+        if not self.claimed:
+            self.cancelled = True
+
+    def abort(self):
+        """
+        Cancels the download, whoever needs it.
+        """
+        self.cancelled = True
+
+    def progress(self):
+        ret = {
+            "received": self.received,
+            "total": self.total,
+            "percent": None
+        }
+        if self.total:
+            ret["percent"] = min(100, 100 * self.received // self.total)
+        return ret
+
+    def wait(self, size=None, timeout=None):
+        """
+        Blocks until at least size bytes are on disk or, without a size,
+        until the download is finished. Returns False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self._arrived(size),
+                timeout
+            )
+
+    def when(self, callback, size=None):
+        """
+        Calls callback once at least size bytes are on disk or, without a
+        size, once the download is finished. Like wait(), but without
+        blocking: the callback runs right away or on the downloading thread,
+        so it has to be quick.
+        """
+        with self.condition:
+            if not self._arrived(size):
+                self.callbacks.append((size, callback))
+                return
+        callback()
+
+    def open(self):
+        """
+        Opens whatever has been written so far for reading.
+        """
+        try:
+            return open(self.part_path, "rb")
+        except FileNotFoundError:
+            # Already renamed into place.
+            return open(self.path, "rb")
+
+    def feed(self, fd):
+        """
+        Writes the song to fd as it arrives, until the download is done.
+        Used to hand a song to the player while it is still downloading.
+        """
+        with self.open() as source, os.fdopen(fd, "wb", 0) as sink:
+            sent = 0
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if chunk:
+                    sink.write(chunk)
+                    sent += len(chunk)
+                    continue
+
+                with self.condition:
+                    if self.done and self.received <= sent:
+                        return
+                    self.condition.wait_for(
+                        lambda: self.done or self.received > sent
+                    )
+
+
+def remove_stale_parts(cache_dir, max_age=PART_MAX_AGE):
+    """
+    Removes the partial downloads in cache_dir that weren't touched for
+    max_age seconds.
+    """
+    deadline = time.time() - max_age
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith((".part", ".part.json")):
+            continue
+        try:
+            if entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def open_fifo_writer(path, timeout):
+    """
+    Opens the write end of a fifo, waiting up to timeout seconds for a
+    reader to show up. Returns None if no reader did.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO or time.monotonic() > deadline:
+                return None
+            time.sleep(.01)
+            continue
+        os.set_blocking(fd, True)
+        return fd
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+urllib handler that keeps HTTP(S) connections to the media server open.
+
+urllib closes the connection after every request, so every Subsonic call
+pays for a new TCP (and TLS) handshake. This handler keeps one connection
+per thread and host around and reuses it for the next request.
+"""
+
+import ssl
+import threading
+import http.client
+import urllib.error
+import urllib.request
+
+
+class KeepAliveHandler(urllib.request.BaseHandler):
+    # Run before urllib's own http handlers, which force "Connection: close".
+    handler_order = 400
+
+    def __init__(self, context=None):
+        self.context = context or ssl.create_default_context()
+        self.local = threading.local()
+
+    def http_open(self, req):
+        return self._open("http", req)
+
+    def https_open(self, req):
+        return self._open("https", req)
+
+    def _connections(self):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        return self.local.connections
+
+    def _connection(self, scheme, host, timeout):
+        connections = self._connections()
+        conn, response = connections.get((scheme, host), (None, None))
+        if conn is not None and (response is None or response.isclosed()):
+            return conn, True
+
+        # Either there is no connection yet or the previous response (e.g.
+        # a song stream) is still being read from it. In the latter case
+        # the old connection is left to the response.
+
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                host, timeout=timeout, context=self.context
+            )
+        else:
+            conn = http.client.HTTPConnection(host, timeout=timeout)
+        connections[(scheme, host)] = (conn, None)
+        return conn, False
+
+    def _forget(self, scheme, host, close=True):
+        conn, _ = self._connections().pop((scheme, host), (None, None))
+        if conn is not None and close:
+            conn.close()
+
+    def _open(self, scheme, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(
+            (k, v) for k, v in req.headers.items() if k not in headers
+        )
+        headers["Connection"] = "keep-alive"
+
+        for attempt in range(2):
+            conn, reused = self._connection(scheme, req.host, req.timeout)
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                self._forget(scheme, req.host)
+                if reused and attempt == 0:
+                    # The server closed the idle connection. Try again.
+                    continue
+                raise urllib.error.URLError(e)
+            break
+
+        if response.will_close:
+            self._forget(scheme, req.host, close=False)
+        else:
+            self._connections()[(scheme, req.host)] = (conn, response)
+
+        # Make the response look like the ones urllib hands out.
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+def install(connection):
+    """
+    Makes a py-sonic Connection reuse its HTTP connections.
+    """
+    opener = getattr(connection, "_opener", None)
+    if opener is not None:
+        opener.add_handler(KeepAliveHandler())
+    return connection
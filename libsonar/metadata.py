@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of media server metadata.
+
+Artists, albums, songs, playlists and search results are kept in a sqlite
+database under CACHE_DIR, keyed by endpoint and call arguments, so that
+re-queuing an album or re-running a search does not go over the network.
+
+Entries expire after a TTL. Playlists are edited without the library
+changing, so they expire after PLAYLIST_TTL. On top of that the whole
+cache is dropped when the library changes, which is detected by asking the
+media server for its indexes with ifModifiedSince set to the last change
+we know about. That check is made at most once per check interval, across
+all processes.
+
+The database is in WAL mode and every thread gets its own connection, so
+the server's lookup threads and any number of clients can read it at once.
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from libsonar.metrics import metrics
+
+logger = logging.getLogger("sonar-server")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (endpoint, key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Endpoints whose responses can be cached. Everything else (streams, random
+# songs, ...) always goes to the media server.
+CACHED_ENDPOINTS = (
+    "getArtist",
+    "getAlbum",
+    "getSong",
+    "getPlaylist",
+    "getPlaylists",
+    "getAlbumList2",
+    "search3",
+)
+
+# Seconds playlists are cached, whatever the TTL. Editing a playlist doesn't
+# change the indexes, so it isn't caught by the check for library changes.
+PLAYLIST_TTL = 60
+
+# Endpoints that expire before the TTL.
+ENDPOINT_TTL = {
+    "getPlaylist": PLAYLIST_TTL,
+    "getPlaylists": PLAYLIST_TTL,
+}
+
+
+class MetadataCache(object):
+    def __init__(self, path, ttl, check_interval=300):
+        self.path = path
+        # Seconds an entry is served without asking the media server.
+        self.ttl = ttl
+        # Seconds between checks for library changes.
+        self.check_interval = check_interval
+        self.local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _meta(self, name, default=0):
+        row = self._db().execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, name, value):
+        self._db().execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+            (name, value)
+        )
+
+    def get(self, endpoint, key):
+        """
+        Returns the cached value, or None if there is none or it expired.
+        """
+        row = self._db().execute(
+            "SELECT fetched, value FROM entries WHERE endpoint = ? AND key = ?",
+            (endpoint, key)
+        ).fetchone()
+        ttl = min(self.ttl, ENDPOINT_TTL.get(endpoint, self.ttl))
+        if row is None or row[0] < time.time() - ttl:
+            return None
+        return json.loads(row[1])
+
+    def put(self, endpoint, key, value):
+        self._db().execute(
+            "INSERT OR REPLACE INTO entries (endpoint, key, fetched, value) "
+            "VALUES (?, ?, ?, ?)",
+            (endpoint, key, time.time(), json.dumps(value))
+        )
+
+    def clear(self):
+        self._db().execute("DELETE FROM entries")
+
+    def purge(self):
+        """
+        Drops the expired entries.
+        """
+        self._db().execute(
+            "DELETE FROM entries WHERE fetched < ?", (time.time() - self.ttl,)
+        )
+
+    def needs_check(self):
+        return self._meta("checked") < time.time() - self.check_interval
+
+    def check(self, connection):
+        """
+        Drops everything if the library changed since the last check.
+        """
+        last_modified = self._meta("last_modified")
+        try:
+            res = connection.getIndexes(ifModifiedSince=int(last_modified))
+        finally:
+            # Don't ask a media server that is down on every lookup either.
+            self._set_meta("checked", time.time())
+        modified = res.get("indexes", {}).get("lastModified", 0)
+
+        if modified > last_modified:
+            if last_modified:
+                logger.info("Library changed. Dropping cached metadata.")
+                self.clear()
+            self._set_meta("last_modified", modified)
+        else:
+            self.purge()
+
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+class MetadataConnection(object):
+    """
+    Stands in for a py-sonic Connection and answers the cacheable calls
+    from a MetadataCache. connect is called to get the real connection the
+    first time the media server is actually needed.
+    """
+    def __init__(self, cache, connect):
+        self.cache = cache
+        self.connect = connect
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            return self.connection
+
+    def __getattr__(self, name):
+        if name not in CACHED_ENDPOINTS:
+            attr = getattr(self._connection(), name)
+            if name.startswith("_") or not callable(attr):
+                return attr
+            return lambda *args, **kwargs: self._fetch(name, args, kwargs)
+
+        def cached(*args, **kwargs):
+            if name == "getAlbumList2" and \
+                    kwargs.get("ltype", args[0] if args else None) == "random":
+                # Supposed to be different every time.
+                return self._fetch(name, args, kwargs)
+            return self._call(name, args, kwargs)
+
+        return cached
+
+    def _fetch(self, name, args, kwargs):
+        connection = self._connection()
+        with metrics.timer("sonar_subsonic_seconds", endpoint=name):
+            return getattr(connection, name)(*args, **kwargs)
+
+    def _call(self, name, args, kwargs):
+        if self.cache.needs_check():
+            try:
+                self.cache.check(self._connection())
+            except Exception as e:
+                # Serving a possibly stale entry beats failing the lookup.
+                logger.warning("Could not check for library changes: %s" % e)
+
+        key = json.dumps([args, kwargs], sort_keys=True)
+        ret = self.cache.get(name, key)
+        if ret is None:
+            metrics.inc(
+                "sonar_metadata_cache_requests_total",
+                endpoint=name,
+                result="miss"
+            )
+            ret = self._fetch(name, args, kwargs)
+            self.cache.put(name, key, ret)
+        else:
+            metrics.inc(
+                "sonar_metadata_cache_requests_total",
+                endpoint=name,
+                result="hit"
+            )
+        return ret
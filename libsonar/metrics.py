@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Counters and histograms of what the server spends its time on.
+
+Everything is recorded in one registry per process, `metrics`, which the
+server exposes through the `metrics` operation and, if `metrics_port` is
+set, as Prometheus text over HTTP. Series are identified by a name and
+labels, e.g. `metrics.observe("sonar_request_seconds", 0.002,
+operation="status")`.
+
+Histograms have fixed buckets, so recording is a bisect and two additions
+no matter how many values were seen. Quantiles are estimated from the
+buckets the way Prometheus' histogram_quantile() does it.
+"""
+
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger("sonar-server")
+
+# Upper bounds of the buckets of latency histograms, in seconds.
+LATENCY_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30
+)
+
+QUANTILES = (.5, .9, .99)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus the values above the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile, interpolating within its bucket. Values
+        above the last bucket are reported as the last bucket.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts[:-1]):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    def __init__(self):
+        # (name, labels) -> value, labels being sorted (name, value) pairs.
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the current value.
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the seconds spent in the block, also if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, value):
+        """
+        Registers a function that returns the value of a gauge when the
+        metrics are read.
+        """
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Returns all series as JSON friendly lists of
+        {"name", "labels", ...}. Histograms come with estimated quantiles
+        instead of their buckets.
+        """
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = []
+            for (name, labels), h in sorted(self.histograms.items()):
+                histogram = {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum
+                }
+                for q in QUANTILES:
+                    histogram["p%d" % round(q * 100)] = h.quantile(q)
+                histograms.append(histogram)
+
+        return {
+            "counters": counters,
+            "histograms": histograms,
+            "gauges": {name: value() for name, value in self.gauges.items()}
+        }
+
+    def prometheus(self):
+        """
+        Returns all series in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name, "counter")
+                lines.append("%s%s %s" % (name, _labels(labels), value))
+
+            for (name, labels), h in sorted(self.histograms.items()):
+                declare(name, "histogram")
+                cumulative = 0
+                bounds = [repr(b) for b in h.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, h.counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        name, _labels(labels + (("le", bound),)), cumulative
+                    ))
+                lines.append("%s_sum%s %s" % (name, _labels(labels), h.sum))
+                lines.append("%s_count%s %d" % (
+                    name, _labels(labels), h.count
+                ))
+
+        for name, value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append("%s %s" % (name, value()))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for name, value in labels
+    )
+
+
+metrics = Metrics()
+
+
+def serve(port, registry=metrics):
+    """
+    Serves the registry as Prometheus text at /metrics on port, from a
+    daemon thread. Returns the HTTP server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Metrics request: %s" % (format % args))
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
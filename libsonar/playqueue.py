@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+"""
+The play queue.
+
+Every entry in the queue gets an id that stays the same while the entry is
+moved around, which is how the current song is tracked: inserting, removing
+or shuffling entries doesn't have to fix up an index. Entries of the same
+song share one track record.
+
+The position of the last looked up entry (in practice the current song) is
+remembered and shifted along with inserts and removes, so looking it up
+does not scan the queue after every edit.
+
+Views of the queue for other threads (see view()) are put together from an
+earlier copy and the history of changes when they are read, so an edit
+doesn't copy the whole queue either.
+"""
+
+import random
+import threading
+from itertools import count
+from collections import deque
+
+# Number of changes remembered for clients catching up on the queue.
+HISTORY_SIZE = 256
+
+
+class QueueHistory(object):
+    """
+    Immutable view of the most recent changes of a queue. Changes are
+    ("insert", position, [[entry id, song], ...]), ("remove", [positions,
+    highest first]) and ("move", source, destination), each bumping the
+    queue version by one.
+    """
+    def __init__(self, version, reset, changes):
+        self.version = version
+        # Version of the last change that can't be replayed (e.g. shuffle).
+        self.reset = reset
+        self.changes = changes
+
+    def since(self, version):
+        """
+        Returns the changes that turn the queue at version into the current
+        one, or None if they are not known anymore.
+        """
+        if version is None or version > self.version or version < self.reset:
+            return None
+        missing = self.version - version
+        if missing > len(self.changes):
+            return None
+        return self.changes[len(self.changes) - missing:]
+
+
+class QueueView(object):
+    """
+    Immutable view of the songs and entry ids of a queue at one version.
+    Unless it is given them, it puts them together on first use, from a
+    view of an earlier version and the changes since.
+    """
+    def __init__(self, version, length, base=None, changes=(), entries=None):
+        self.version = version
+        self.length = length
+        self.base = base
+        self.changes = changes
+        # (entry ids, songs) once put together.
+        self.entries = entries
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def songs(self):
+        return self._build()[1]
+
+    def entry_ids(self):
+        return self._build()[0]
+
+    def _build(self):
+        with self.lock:
+            if self.entries is None:
+                entries = list(zip(*self.base.entries))
+                for change in self.changes:
+                    if change[0] == "insert":
+                        _, position, inserted = change
+                        entries[position:position] = [
+                            tuple(e) for e in inserted
+                        ]
+                    elif change[0] == "remove":
+                        for position in change[1]:
+                            del entries[position]
+                    elif change[0] == "move":
+                        _, source, destination = change
+                        entries.insert(destination, entries.pop(source))
+
+                self.entries = (
+                    tuple(entry_id for entry_id, _ in entries),
+                    tuple(song for _, song in entries)
+                )
+                # Don't keep older views alive.
+                self.base = self.changes = None
+            return self.entries
+
+
+class PlayQueue(object):
+    def __init__(self):
+        # Entry ids in play order.
+        self.order = []
+        # entry id -> song id
+        self.entries = {}
+        # song id -> song, shared by all entries of the song, and the
+        # number of entries of each song.
+        self.tracks = {}
+        self.refs = {}
+        self.ids = count(1)
+
+        # (entry id, position) of the last looked up entry, or None.
+        self.known = None
+
+        # Entry id of the current song.
+        self.current = None
+
+        # Order before shuffling, and the seed of the shuffle.
+        self.unshuffled = None
+        self.seed = None
+
+        # Bumped on every change of the order or the entries.
+        self.version = 0
+        self.changes = deque(maxlen=HISTORY_SIZE)
+        self.reset = 0
+        self._songs = None
+        self._entry_ids = None
+        self._history = None
+        # The current view, the one before it and the latest view that was
+        # put together, see view().
+        self._view = None
+        self._previous = None
+        self._base = None
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        return self.tracks[self.entries[self.order[position]]]
+
+    def __iter__(self):
+        return iter(self.songs())
+
+    def songs(self):
+        """
+        Returns the songs in play order. The tuple is shared until the queue
+        changes, so it can be handed out without copying.
+        """
+        if self._songs is None:
+            self._songs = tuple(
+                self.tracks[self.entries[entry_id]] for entry_id in self.order
+            )
+        return self._songs
+
+    def entry_ids(self):
+        """
+        Returns the entry ids in play order, shared like songs().
+        """
+        if self._entry_ids is None:
+            self._entry_ids = tuple(self.order)
+        return self._entry_ids
+
+    def view(self):
+        """
+        Returns a QueueView of the queue as it is now, shared until the queue
+        changes. The queue is only copied when the changes since the latest
+        view that was put together aren't in the history anymore.
+        """
+        if self._view is None:
+            base, previous = self._base, self._previous
+            if previous is not None and previous.entries is not None and \
+                    (base is None or previous.version > base.version):
+                base = previous
+
+            changes = None
+            if base is not None:
+                changes = self.history().since(base.version)
+            if changes is None:
+                base = self._view = QueueView(
+                    self.version,
+                    len(self.order),
+                    entries=(self.entry_ids(), self.songs())
+                )
+            else:
+                self._view = QueueView(
+                    self.version, len(self.order), base, changes
+                )
+            self._base = base
+            self._previous = None
+        return self._view
+
+    def history(self):
+        if self._history is None:
+            self._history = QueueHistory(
+                self.version, self.reset, tuple(self.changes)
+            )
+        return self._history
+
+    def _changed(self, known=None, change=None):
+        self.known = known
+        self.version += 1
+        if change is None:
+            # Clients have to fetch the whole queue again.
+            self.changes.clear()
+            self.reset = self.version
+        else:
+            self.changes.append(change)
+        self._songs = None
+        self._entry_ids = None
+        self._history = None
+        if self._view is not None:
+            self._previous = self._view
+            self._view = None
+
+    def entry_id(self, position):
+        return self.order[position]
+
+    def position(self, entry_id):
+        """
+        Returns the current position of an entry, or None if it is gone.
+        """
+        if entry_id not in self.entries:
+            return None
+
+        if self.known and self.known[0] == entry_id:
+            return self.known[1]
+
+        position = self.order.index(entry_id)
+        self.known = (entry_id, position)
+        return position
+
+    @property
+    def current_position(self):
+        if self.current is None:
+            return None
+        return self.position(self.current)
+
+    @current_position.setter
+    def current_position(self, position):
+        if position is None or not 0 <= position < len(self.order):
+            self.current = None
+        else:
+            self.current = self.order[position]
+
+    def insert(self, position, songs):
+        """
+        Inserts songs before position. Returns the new entry ids.
+        """
+        entry_ids = []
+        for song in songs:
+            song_id = str(song["id"])
+            entry_id = next(self.ids)
+            self.tracks[song_id] = song
+            self.refs[song_id] = self.refs.get(song_id, 0) + 1
+            self.entries[entry_id] = song_id
+            entry_ids.append(entry_id)
+
+        position = min(max(position, 0), len(self.order))
+        self.order[position:position] = entry_ids
+        if self.unshuffled is not None:
+            self.unshuffled.extend(entry_ids)
+
+        known = self.known
+        if known and known[1] >= position:
+            known = (known[0], known[1] + len(entry_ids))
+        self._changed(known, ("insert", position, [
+            [entry_id, self[position + i]]
+            for i, entry_id in enumerate(entry_ids)
+        ]))
+        return entry_ids
+
+    def extend(self, songs):
+        return self.insert(len(self.order), songs)
+
+    def remove(self, positions):
+        """
+        Removes the entries at the given positions. If the current entry is
+        removed, the entry before it becomes the current one.
+        """
+        positions = sorted(
+            {p for p in positions if 0 <= p < len(self.order)},
+            reverse=True
+        )
+        if not positions:
+            return
+
+        current = self.current_position
+        # Highest first, so the positions still to go stay put.
+        for position in positions:
+            self._forget(self.order.pop(position))
+
+        known = None
+        if current is not None:
+            # Step back to the closest surviving entry before it if the
+            # current entry itself was removed.
+            current -= sum(1 for p in positions if p <= current)
+            if self.current not in self.entries:
+                self.current = self.order[max(current, 0)] \
+                    if self.order else None
+            if self.current is not None:
+                known = (self.current, max(current, 0))
+        self._changed(known, ("remove", positions))
+
+    def _forget(self, entry_id):
+        # Left in the unshuffled order, which unshuffle() filters.
+        song_id = self.entries.pop(entry_id)
+        self.refs[song_id] -= 1
+        if not self.refs[song_id]:
+            del self.refs[song_id]
+            del self.tracks[song_id]
+
+    def move(self, source, destination):
+        """
+        Moves the entry at source so that it ends up at destination.
+        """
+        entry_id = self.order.pop(source)
+        destination = min(max(destination, 0), len(self.order))
+        self.order.insert(destination, entry_id)
+
+        known = self.known
+        if known and known[0] == entry_id:
+            known = (entry_id, destination)
+        elif known:
+            position = known[1] - (known[1] > source)
+            known = (known[0], position + (position >= destination))
+        self._changed(known, ("move", source, destination))
+
+    def clear(self):
+        self.order = []
+        self.entries.clear()
+        self.tracks.clear()
+        self.refs.clear()
+        self.current = None
+        self.unshuffled = None
+        self.seed = None
+        self._changed()
+
+    def shuffle(self, seed=None):
+        """
+        Shuffles the queue, putting the current entry first. The same seed
+        gives the same order. Returns the seed.
+        """
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        if self.unshuffled is None:
+            self.unshuffled = list(self.order)
+        self.seed = seed
+
+        rest = [e for e in self.order if e != self.current]
+        random.Random(seed).shuffle(rest)
+        if self.current is not None:
+            rest.insert(0, self.current)
+        self.order = rest
+        self._changed()
+        return seed
+
+    def unshuffle(self):
+        """
+        Restores the order from before the queue was shuffled. Entries added
+        since then stay where they were added, at the end.
+        """
+        if self.unshuffled is None:
+            return
+        self.order = [e for e in self.unshuffled if e in self.entries]
+        self.unshuffled = None
+        self.seed = None
+        self._changed()
+
+    @property
+    def shuffled(self):
+        return self.unshuffled is not None
+
+    def sort(self, key):
+        self.order.sort(
+            key=lambda entry_id: key(self.tracks[self.entries[entry_id]])
+        )
+        self.unshuffled = None
+        self.seed = None
+        self._changed()
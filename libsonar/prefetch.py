@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Background prefetching of the songs coming up in the queue.
+
+The server tells the scheduler which songs it wants in the cache, most
+wanted first, whenever the queue or the current song changes. A fixed
+number of workers download them in that order. Prefetches that are no
+longer wanted are cancelled, and all prefetches share a bandwidth budget
+so they don't starve the song that is playing.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger("sonar-server")
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all prefetch downloads. rate is in bytes per
+    second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+class PrefetchScheduler(object):
+    def __init__(self, player, cache, workers):
+        self.player = player
+        self.cache = cache
+
+        self.wanted = []
+        self.songs = {}
+        self.active = {}
+        self.skipped = set()
+        self.condition = threading.Condition()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def schedule(self, songs):
+        """
+        Replaces the list of songs to prefetch. Prefetches of songs that are
+        not in the new list are cancelled.
+        """
+        with self.condition:
+            self.songs = {str(song["id"]): song for song in songs}
+            self.wanted = list(self.songs)
+            self.skipped.clear()
+            for song_id, download in self.active.items():
+                if song_id not in self.wanted:
+                    logger.debug("Cancelling prefetch of song: %s" % song_id)
+                    download.cancel()
+            self.condition.notify_all()
+
+    def _next_song(self):
+        for song_id in self.wanted:
+            if song_id in self.active or \
+                    song_id in self.skipped or \
+                    song_id in self.cache:
+                continue
+            return song_id
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(self._next_song)
+                song_id = self._next_song()
+                try:
+                    download = self.player._start_download(
+                        self.songs[song_id],
+                        prefetch=True
+                    )
+                except Exception as e:
+                    logger.warning("Could not prefetch song %s: %s" % (
+                        song_id, e
+                    ))
+                    self.skipped.add(song_id)
+                    continue
+                if download is None:
+                    # Turned out to be on disk already.
+                    self.skipped.add(song_id)
+                    continue
+                self.active[song_id] = download
+
+            logger.info("Prefetching song: %s" % song_id)
+            download.wait()
+
+            with self.condition:
+                del self.active[song_id]
+                if download.error and not download.cancelled:
+                    # Don't retry it until the wanted list changes.
+                    self.skipped.add(song_id)
+                self.condition.notify_all()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Wire protocol spoken between sonar and sonar-server.
+
+A framed connection starts with the client sending MAGIC followed by the
+highest protocol version it speaks. The server answers with MAGIC and the
+version it picked. After that every message in either direction is a 4 byte
+big endian payload length followed by the UTF-8 encoded JSON payload.
+
+Legacy clients send a single JSON document and read a single JSON document
+back. The server tells them apart from framed clients by the first byte.
+"""
+
+import json
+import struct
+
+MAGIC = b"SNR"
+PROTOCOL_VERSION = 1
+
+HANDSHAKE = struct.Struct("!3sB")
+HEADER = struct.Struct("!I")
+
+# Refuse to allocate buffers for absurdly large frames.
+MAX_FRAME_SIZE = 256 << 20
+
+# Max number of buffers handed to a single sendmsg() call.
+IOV_MAX = 64
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_framed(first_byte):
+    return first_byte == MAGIC[:1]
+
+
+def encode_handshake(version=PROTOCOL_VERSION):
+    return HANDSHAKE.pack(MAGIC, version)
+
+
+def decode_handshake(data):
+    magic, version = HANDSHAKE.unpack(bytes(data))
+    if magic != MAGIC:
+        raise ProtocolError("Not a sonar protocol handshake.")
+    return version
+
+
+def negotiate_version(client_version):
+    if client_version < 1:
+        raise ProtocolError(
+            "Unsupported protocol version: %s" % client_version
+        )
+    return min(client_version, PROTOCOL_VERSION)
+
+
+def encode_frame(message):
+    """
+    Returns the header and payload as separate buffers so that they can
+    be written with a single sendmsg() without joining them.
+    """
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError("Message too large: %d bytes" % len(payload))
+    return HEADER.pack(len(payload)), payload
+
+
+class FrameDecoder(object):
+    """
+    Incremental decoder. Feed it whatever recv() returned and iterate over
+    it to get the messages that are complete so far.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def __iter__(self):
+        while len(self.buffer) >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError("Frame too large: %d bytes" % length)
+
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                # Wait for the rest of the frame.
+                return
+
+            with memoryview(self.buffer) as view:
+                payload = bytes(view[HEADER.size:end])
+            del self.buffer[:end]
+            yield json.loads(payload.decode("utf-8"))
+
+
+def sendmsg_all(sock, buffers):
+    """
+    Like socket.sendall() but for a list of buffers.
+    """
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed by peer.")
+        view = view[received:]
+    return buf
+
+
+def send_message(sock, message, handshake=False):
+    buffers = list(encode_frame(message))
+    if handshake:
+        buffers.insert(0, encode_handshake())
+    sendmsg_all(sock, buffers)
+
+
+def recv_handshake(sock):
+    return decode_handshake(recv_exactly(sock, HANDSHAKE.size))
+
+
+def recv_message(sock):
+    length, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large: %d bytes" % length)
+    return json.loads(recv_exactly(sock, length).decode("utf-8"))
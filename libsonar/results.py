@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Store for the results of the last search (or listing), which later commands
+refer to by index.
+
+The file is memory-mapped and read lazily: picking result 3 of a 10000 song
+listing decodes only that result. Layout, all integers big endian:
+
+    header      MAGIC, format version (H), number of kinds (H)
+    kinds       per kind: name (16s), number of entries (I), offset of its
+                offset table (Q)
+    tables      per kind: number of entries + 1 offsets (Q) into the file,
+                entry i being the bytes between offsets i and i + 1
+    entries     UTF-8 encoded JSON, one document per entry
+
+The file is written next to its final path and renamed into place, so a
+client reading it never sees a half written store.
+"""
+
+import os
+import json
+import mmap
+import struct
+from collections.abc import Mapping, Sequence
+
+MAGIC = b"SNRR"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("!4sHH")
+KIND = struct.Struct("!16sIQ")
+OFFSET = struct.Struct("!Q")
+
+
+class ResultList(Sequence):
+    def __init__(self, buf, table, count):
+        self.buf = buf
+        self.table = table
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("result index out of range")
+
+        start, = OFFSET.unpack_from(self.buf, self.table + idx * OFFSET.size)
+        end, = OFFSET.unpack_from(
+            self.buf, self.table + (idx + 1) * OFFSET.size
+        )
+        return json.loads(self.buf[start:end].decode("utf-8"))
+
+
+class Results(Mapping):
+    """
+    Read-only {kind: [entries]} view of a results file.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        magic, version, kinds = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a version %d results file." % FORMAT_VERSION)
+
+        self.kinds = {}
+        for i in range(kinds):
+            name, count, table = KIND.unpack_from(
+                buf, HEADER.size + i * KIND.size
+            )
+            name = name.rstrip(b"\0").decode("ascii")
+            self.kinds[name] = ResultList(buf, table, count)
+
+    def __getitem__(self, kind):
+        return self.kinds[kind]
+
+    def __iter__(self):
+        return iter(self.kinds)
+
+    def __len__(self):
+        return len(self.kinds)
+
+
+def read_results(path):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Results(buf)
+
+
+def write_results(path, results):
+    kinds = [(k, v) for k, v in results.items() if isinstance(v, list)]
+
+    position = HEADER.size + len(kinds) * KIND.size
+    header = [HEADER.pack(MAGIC, FORMAT_VERSION, len(kinds))]
+    tables = []
+    entries = []
+    for kind, entry_list in kinds:
+        header.append(
+            KIND.pack(kind.encode("ascii"), len(entry_list), position)
+        )
+        position += (len(entry_list) + 1) * OFFSET.size
+        tables.append(entry_list)
+
+    offsets = []
+    for entry_list in tables:
+        encoded = [
+            json.dumps(entry, separators=(",", ":")).encode("utf-8")
+            for entry in entry_list
+        ]
+        table = [position]
+        for data in encoded:
+            position += len(data)
+            table.append(position)
+        offsets.append(struct.pack("!%dQ" % len(table), *table))
+        entries.extend(encoded)
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.writelines(header + offsets + entries)
+    os.replace(tmp_path, path)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Local full-text index of the media server library.
+
+Artists, albums and songs are kept in a sqlite database with FTS5 tables
+on top, so searches are answered without asking the media server. Every
+word of a query is matched as a prefix and results are ranked by bm25.
+The database is memory-mapped rather than read into memory, which keeps
+opening it cheap even for large libraries.
+
+The index is filled from the album list. A refresh pages through all
+albums and only fetches the songs of albums that are new or changed, and
+drops the ones that are gone.
+"""
+
+import re
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger("sonar-client")
+
+# Upper limit of the memory mapping, not memory use.
+MMAP_SIZE = 1 << 30
+
+TOKENIZE = "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    artist_id TEXT,
+    signature TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS songs (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    album_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_album_id ON songs (album_id);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Searched columns of each table. The fts tables only index them and read
+# the values from the tables above.
+COLUMNS = {
+    "artist": ("artists", ("name",)),
+    "album": ("albums", ("name", "artist")),
+    "song": ("songs", ("title", "artist", "album")),
+}
+
+# What a search result looks like, the same as the media server's.
+FIELDS = {
+    "artist": ("id", "name"),
+    "album": ("id", "name", "artist"),
+    "song": ("id", "title", "artist", "album"),
+}
+
+
+class SearchIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # Have REPLACE fire the delete triggers, so the fts tables follow.
+        self.db.execute("PRAGMA recursive_triggers = ON")
+        self.db.executescript(SCHEMA)
+        for table, columns in COLUMNS.values():
+            self._create_fts(table, columns)
+
+    def _create_fts(self, table, columns):
+        columns = ", ".join(columns)
+        new = ", ".join("new.%s" % c for c in columns.split(", "))
+        old = ", ".join("old.%s" % c for c in columns.split(", "))
+        self.db.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {columns}, content = '{table}', {tokenize}
+            );
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {table}_fts (rowid, {columns})
+                VALUES (new.rowid, {new});
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {columns})
+                VALUES ('delete', old.rowid, {old});
+            END;
+        """.format(
+            table=table, columns=columns, new=new, old=old, tokenize=TOKENIZE
+        ))
+
+    def _meta(self, name, default=0):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def age(self):
+        """
+        Seconds since the last refresh, or None if there never was one.
+        """
+        refreshed = self._meta("refreshed")
+        return time.time() - refreshed if refreshed else None
+
+    def _albums(self, connection, page_size):
+        offset = 0
+        while True:
+            res = connection.getAlbumList2(
+                ltype="alphabeticalByName",
+                size=page_size,
+                offset=offset
+            )
+            albums = res.get("albumList2", {}).get("album", [])
+            if isinstance(albums, dict):
+                albums = [albums]
+            for album in albums:
+                yield album
+            if len(albums) < page_size:
+                return
+            offset += page_size
+
+    def refresh(self, connection, page_size=500):
+        """
+        Brings the index up to date with the library. Returns the number of
+        albums that were (re)indexed and removed.
+        """
+        known = dict(self.db.execute("SELECT id, signature FROM albums"))
+        seen = set()
+        updated = 0
+
+        for album in self._albums(connection, page_size):
+            album_id = str(album["id"])
+            seen.add(album_id)
+            signature = "%s:%s:%s" % (
+                album.get("songCount"),
+                album.get("duration"),
+                album.get("created")
+            )
+            if known.get(album_id) == signature:
+                continue
+
+            songs = connection.getAlbum(album_id)["album"].get("song", [])
+            if isinstance(songs, dict):
+                songs = [songs]
+
+            with self.db:
+                self.db.execute("BEGIN")
+                self._remove_album(album_id)
+                self.db.execute(
+                    "INSERT INTO albums (id, name, artist, artist_id, "
+                    "signature) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        album_id,
+                        album.get("name") or album.get("title", ""),
+                        album.get("artist", ""),
+                        album.get("artistId"),
+                        signature
+                    )
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO songs (id, title, artist, album, "
+                    "album_id) VALUES (?, ?, ?, ?, ?)",
+                    [(
+                        str(song["id"]),
+                        song.get("title", ""),
+                        song.get("artist", ""),
+                        song.get("album", ""),
+                        album_id
+                    ) for song in songs]
+                )
+            updated += 1
+
+        removed = set(known) - seen
+        with self.db:
+            self.db.execute("BEGIN")
+            for album_id in removed:
+                self._remove_album(album_id)
+
+            # Artists are the album artists, so they follow the albums.
+            self.db.execute("DELETE FROM artists")
+            self.db.execute(
+                "INSERT OR IGNORE INTO artists (id, name) "
+                "SELECT artist_id, artist FROM albums "
+                "WHERE artist_id IS NOT NULL"
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) "
+                "VALUES ('refreshed', ?)", (time.time(),)
+            )
+
+        logger.info("Search index: %d albums updated, %d removed." % (
+            updated, len(removed)
+        ))
+        return updated, len(removed)
+
+    def _remove_album(self, album_id):
+        self.db.execute("DELETE FROM songs WHERE album_id = ?", (album_id,))
+        self.db.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+
+    def search(self, kind, query, limit):
+        """
+        Returns up to limit entries of kind ("artist", "album" or "song")
+        matching every word in query, best match first.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+
+        table, _ = COLUMNS[kind]
+        fields = FIELDS[kind]
+        rows = self.db.execute(
+            "SELECT {fields} FROM {table}_fts "
+            "JOIN {table} ON {table}.rowid = {table}_fts.rowid "
+            "WHERE {table}_fts MATCH ? ORDER BY rank LIMIT ?".format(
+                fields=", ".join("%s.%s" % (table, f) for f in fields),
+                table=table
+            ),
+            (" ".join('"%s"*' % word for word in words), int(limit))
+        )
+        return [dict(zip(fields, row)) for row in rows]
+
+    def close(self):
+        self.db.close()
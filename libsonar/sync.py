@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""
+Bulk downloads of songs into the music cache, for listening offline.
+
+Synced songs are pinned in the cache index, so playing other music doesn't
+evict them, and a sync stops when the pinned songs would no longer fit in
+the cache limit. A fixed number of workers download the songs, unthrottled
+unlike prefetches. Cancelling drops the songs that haven't started; the
+ones downloading finish.
+
+The pins and the songs still to download are saved to a state file, so a
+sync that was interrupted by a restart picks up where it left off. Songs
+that broke off half way are resumed by the downloads themselves.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("sonar-server")
+
+# Seconds between saves of the state while a sync is running.
+SAVE_INTERVAL = 5
+
+
+class SyncScheduler(object):
+    def __init__(self, player, cache, state_file, workers):
+        self.player = player
+        self.cache = cache
+        self.state_file = state_file
+
+        # song id -> song, in the order they are downloaded.
+        self.pending = OrderedDict()
+        # Songs being downloaded, and their downloads once they started.
+        self.active = {}
+        self.downloads = {}
+        # song id -> why it could not be synced.
+        self.failed = {}
+        # Progress of the current sync. Reset when a sync is started while
+        # the last one is done.
+        self.total = 0
+        self.done = 0
+        self.received = 0
+        # Set when the pinned songs fill the cache limit.
+        self.full = False
+        self.saved = 0
+        self.condition = threading.Condition()
+
+        self._load()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "rt") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning("Sync state is corrupt (%s). Ignoring it." % e)
+            return
+
+        self.cache.pin(state.get("pinned", []))
+        for song in state.get("pending", []):
+            self.pending[str(song["id"])] = song
+        self.total = len(self.pending)
+        if self.pending:
+            logger.info("Resuming sync of %d songs." % len(self.pending))
+
+    def _save(self):
+        """
+        Writes the state file. Called with the condition held.
+        """
+        state = {
+            "pinned": sorted(self.cache.pinned),
+            # Songs downloading now have to be started again after a restart.
+            "pending": list(self.active.values()) + list(self.pending.values())
+        }
+        tmp_file = "%s.tmp" % self.state_file
+        with open(tmp_file, "wt") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+        self.saved = time.monotonic()
+
+    def add(self, songs, errors=()):
+        """
+        Pins songs and queues them for download. Songs that are cached
+        already only get pinned.
+        """
+        with self.condition:
+            if not self.pending and not self.active:
+                self.total = self.done = self.received = 0
+                self.failed.clear()
+            self.full = False
+
+            for error in errors:
+                self.failed["%s %s" % (error["kind"], error["id"])] = \
+                    error["message"]
+            for song in songs:
+                song_id = str(song["id"])
+                if song_id in self.pending or song_id in self.active:
+                    continue
+                self.failed.pop(song_id, None)
+                self.pending[song_id] = song
+                self.total += 1
+
+            self.cache.pin(self.pending)
+            self._save()
+            self.condition.notify_all()
+
+        logger.info("Syncing %d songs." % len(self.pending))
+
+    def cancel(self):
+        """
+        Drops the songs that haven't started downloading, and their pins.
+        """
+        with self.condition:
+            self.cache.unpin(self.pending)
+            self.total -= len(self.pending)
+            self.pending.clear()
+            self.full = False
+            self._save()
+
+    def clear(self):
+        """
+        Cancels the sync and unpins all synced songs. They stay in the cache
+        until they are evicted like any other song.
+        """
+        with self.condition:
+            self.cancel()
+            self.cache.unpin(set(self.cache.pinned) - set(self.active))
+            self._save()
+
+    def status(self):
+        with self.condition:
+            if self.full:
+                state = "full"
+            elif self.pending or self.active:
+                state = "syncing"
+            else:
+                state = "idle"
+
+            return {
+                "state": state,
+                "total": self.total,
+                "done": self.done,
+                "pending": len(self.pending),
+                "received": self.received + sum(
+                    d.received for d in self.downloads.values()
+                ),
+                "downloading": {
+                    song_id: d.progress()
+                    for song_id, d in self.downloads.items()
+                },
+                "failed": dict(self.failed),
+                "pinned": len(self.cache.pinned),
+                "pinned_size": self.cache.pinned_size,
+                "limit": self.cache.limit
+            }
+
+    def _next_song(self):
+        if self.full or not self.pending:
+            return None
+
+        song_id, song = next(iter(self.pending.items()))
+        # The songs downloading now aren't in the pinned size yet.
+        needed = sum(
+            s.get("size") or 0 for s in [song] + list(self.active.values())
+        )
+        if song_id not in self.cache and \
+                self.cache.pinned_size + needed > self.cache.limit:
+            logger.warning("Synced songs fill the cache. Stopping the sync.")
+            self.full = True
+            self._save()
+            return None
+
+        del self.pending[song_id]
+        return song_id, song
+
+    def _work(self):
+        while True:
+            with self.condition:
+                next_song = None
+                while next_song is None:
+                    self.condition.wait_for(self._next_song_ready)
+                    next_song = self._next_song()
+                song_id, song = next_song
+                # Saved as pending until it is done.
+                self.active[song_id] = song
+
+            download = None
+            error = None
+            try:
+                download = self.player._start_download(song)
+            except Exception as e:
+                error = e
+            if download is not None:
+                with self.condition:
+                    self.downloads[song_id] = download
+                download.wait()
+                error = download.error
+
+            with self.condition:
+                del self.active[song_id]
+                self.downloads.pop(song_id, None)
+                if error:
+                    logger.warning("Could not sync song %s: %s" % (
+                        song_id, error
+                    ))
+                    self.failed[song_id] = str(error)
+                    self.cache.unpin([song_id])
+                else:
+                    self.done += 1
+                    if download is not None:
+                        self.received += download.received
+                if not self.pending and not self.active:
+                    logger.info("Sync done: %d songs, %d failed." % (
+                        self.done, len(self.failed)
+                    ))
+                    self._save()
+                elif time.monotonic() - self.saved > SAVE_INTERVAL:
+                    self._save()
+                self.condition.notify_all()
+
+    def _next_song_ready(self):
+        return not self.full and bool(self.pending)
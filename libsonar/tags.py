@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Index of the tags of the songs in the music cache.
+
+The server records the media server's metadata of every song it downloads,
+so listing the cache doesn't have to open every file and is not limited to
+what fits in an ID3v1 tag. Rows remember the size and inode of the file
+they describe. A row that doesn't match its file anymore is refreshed from
+the file's ID3v1 tag, which is also where songs cached before the index
+existed get their tags from.
+
+The mtime is deliberately not used for validation, as the server touches
+songs whenever they are played to keep track of their last use.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    track INTEGER,
+    size INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_title ON tags (title);
+CREATE INDEX IF NOT EXISTS tags_artist ON tags (artist, album, track);
+CREATE INDEX IF NOT EXISTS tags_album ON tags (album, track);
+"""
+
+# Sort orders `cached` can list songs in.
+ORDER_BY = {
+    "title": "title, artist",
+    "artist": "artist, album, track",
+    "album": "album, track",
+}
+
+ID3V1_FIELDS = {
+    "title": (3, 33),
+    "artist": (33, 63),
+    "album": (63, 93),
+}
+
+
+def read_id3v1(song_id, path):
+    """
+    Returns the song's ID3v1 tags, or None if it has none.
+    """
+    with open(path, "rb", 0) as song_file:
+        song_file.seek(-128, 2)
+        tag_data = song_file.read(128)
+
+    if tag_data[:3] != b"TAG":
+        return None
+
+    song = {"id": song_id}
+    for tag, (start, end) in ID3V1_FIELDS.items():
+        song[tag] = tag_data[start:end].decode(
+            "utf-8", "replace").replace("\x00", "").strip()
+    return song
+
+
+class TagIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    def add(self, song, path):
+        """
+        Records the tags of a song that was just written to path.
+        """
+        stat = os.stat(path)
+        track = song.get("track")
+        self._db().execute(
+            "INSERT OR REPLACE INTO tags "
+            "(id, title, artist, album, track, size, inode, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(song["id"]),
+                song.get("title", ""),
+                song.get("artist", ""),
+                song.get("album", ""),
+                track if isinstance(track, int) else None,
+                stat.st_size,
+                stat.st_ino,
+                json.dumps(song)
+            )
+        )
+
+    def ids(self):
+        return {row[0] for row in self._db().execute("SELECT id FROM tags")}
+
+    def remove(self, song_ids):
+        self._db().executemany(
+            "DELETE FROM tags WHERE id = ?", [(i,) for i in song_ids]
+        )
+
+    def sync(self, cache_dir, song_ids):
+        """
+        Makes the index cover exactly the given cached songs: rows of songs
+        that are gone are dropped, and songs without a row get one from
+        their ID3v1 tags.
+        """
+        indexed = self.ids()
+        self.remove(indexed - song_ids)
+        for song_id in song_ids - indexed:
+            self._refresh(cache_dir, song_id)
+
+    def _refresh(self, cache_dir, song_id):
+        path = os.path.join(cache_dir, "%s.mp3" % song_id)
+        try:
+            song = read_id3v1(song_id, path)
+        except OSError:
+            song = None
+        if song is None:
+            self.remove([song_id])
+            return None
+        self.add(song, path)
+        return song
+
+    def songs(self, cache_dir, sort="artist", offset=0, limit=None):
+        """
+        Returns a page of the indexed songs. Only the rows on the page are
+        checked against their files.
+        """
+        rows = self._db().execute(
+            "SELECT id, size, inode, data FROM tags ORDER BY %s "
+            "LIMIT ? OFFSET ?" % ORDER_BY[sort],
+            (-1 if limit is None else limit, offset)
+        ).fetchall()
+
+        songs = []
+        for song_id, size, inode, data in rows:
+            try:
+                stat = os.stat(os.path.join(cache_dir, "%s.mp3" % song_id))
+            except OSError:
+                self.remove([song_id])
+                continue
+
+            if (stat.st_size, stat.st_ino) == (size, inode):
+                songs.append(json.loads(data))
+            else:
+                # The file was replaced behind our back.
+                song = self._refresh(cache_dir, song_id)
+                if song:
+                    songs.append(song)
+        return songs
+
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None:
+            db.close()
+            self.local.db = None
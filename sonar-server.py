@@ -27,345 +27,1067 @@ import logging
 import logging.config
 import json
 import threading
+import selectors
+from collections import deque
 from sys import platform
 from operator import itemgetter
-from random import shuffle
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 from libsonar import Subsonic
-from libsonar import ensure_paths, read_config
+from libsonar import ensure_paths, read_config, open_stream
+from libsonar import protocol
+from libsonar.download import Download, DownloadCancelled
+from libsonar.download import open_fifo_writer, remove_stale_parts
+from libsonar.cache import CacheIndex
+from libsonar.prefetch import PrefetchScheduler, RateLimiter
+from libsonar.sync import SyncScheduler
+from libsonar.metrics import metrics, serve as serve_metrics
+from libsonar.metadata import MetadataCache, MetadataConnection
+from libsonar.tags import TagIndex
+from libsonar.playqueue import PlayQueue
 
 from mplayer import Player as MPlayer
 
-from variables import CACHE_DIR, MUSIC_CACHE_DIR
-from variables import LOG_CONFIG, PID_FILE
+from variables import CACHE_DIR, MUSIC_CACHE_DIR, CACHE_INDEX_FILE
+from variables import METADATA_CACHE_FILE, TAG_INDEX_FILE, SYNC_STATE_FILE
+from variables import LOG_CONFIG, PID_FILE, RUN_DIR, SOCKET_FILE
+
+class MessageQueue(Queue):
+    """
+    A queue that can be watched by the server's selector. Every put also
+    writes a byte to a socket pair so that the server loop wakes up.
+    """
+    def __init__(self, maxsize=0):
+        super(MessageQueue, self).__init__(maxsize)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(0)
+        self._wakeup_w.setblocking(0)
+
+    def put(self, item, block=True, timeout=None):
+        super(MessageQueue, self).put(item, block, timeout)
+        try:
+            self._wakeup_w.send(b"\0")
+        except BlockingIOError:
+            # The wakeup buffer is full, the server is already awake.
+            pass
 
-msg_queue = Queue(1)
+    def fileno(self):
+        return self._wakeup_r.fileno()
+
+    def clear_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class ClientConnection(object):
+    """
+    Buffers the traffic of a single client connection so that the server
+    loop never blocks on a slow or chatty client.
+    """
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.framed = None
+        self.version = None
+        self.legacy_data = bytearray()
+        self.decoder = protocol.FrameDecoder()
+        self.out = deque()
+        self.close_when_flushed = False
+        self.closed = False
+        # Set when the client sent changes the worker may not have applied
+        # yet. Requests that read the state then wait in held until it has.
+        self.unapplied = False
+        self.waiting = False
+        self.held = deque()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def feed(self, data):
+        """
+        Returns the requests that are complete after receiving data.
+        """
+        if self.framed is None:
+            self.framed = protocol.is_framed(data[:1])
+
+        if not self.framed:
+            # Legacy clients send exactly one JSON document per connection.
+            # Keep reading until it parses.
+            if self.close_when_flushed:
+                return []
+            self.legacy_data += data
+            if len(self.legacy_data) > protocol.MAX_FRAME_SIZE:
+                raise protocol.ProtocolError("Request too large.")
+            if b"}" not in data:
+                # Can't be a complete object yet.
+                return []
+            try:
+                request, _ = json.JSONDecoder().raw_decode(
+                    self.legacy_data.decode("utf-8").strip()
+                )
+            except ValueError:
+                return []
+            return [request]
+
+        self.decoder.feed(data)
+        if self.version is None:
+            # Framed clients start with a handshake. Answer it with the
+            # protocol version we are going to speak.
+            if len(self.decoder.buffer) < protocol.HANDSHAKE.size:
+                return []
+            handshake = self.decoder.buffer[:protocol.HANDSHAKE.size]
+            del self.decoder.buffer[:protocol.HANDSHAKE.size]
+            self.version = protocol.negotiate_version(
+                protocol.decode_handshake(handshake)
+            )
+            self.out.append(
+                memoryview(protocol.encode_handshake(self.version))
+            )
+
+        return list(self.decoder)
+
+    def send(self, message):
+        if self.framed:
+            self.out.extend(memoryview(b) for b in protocol.encode_frame(message))
+        else:
+            self.out.append(memoryview(json.dumps(message).encode("utf-8")))
+            self.close_when_flushed = True
+
+    def flush(self):
+        """
+        Writes as much of the pending output as the socket takes. Returns
+        True when everything has been written.
+        """
+        while self.out:
+            try:
+                sent = self.sock.sendmsg(list(self.out)[:protocol.IOV_MAX])
+            except BlockingIOError:
+                return False
+            while self.out and sent >= len(self.out[0]):
+                sent -= len(self.out.popleft())
+            if sent:
+                self.out[0] = self.out[0][sent:]
+        return True
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+msg_queue = MessageQueue()
 
 
 class SonarServer(object):
+    # Order of a sorted queue.
+    sort_key = itemgetter("artistId", "albumId", "discNumber", "track")
+
+    operations = (
+        "status",
+        "play",
+        "pause",
+        "stop",
+        "previous_song",
+        "next_song",
+        "seek",
+        "repeat",
+        "shuffle",
+        "sort_queue",
+        "unshuffle_queue",
+        "set_queue",
+        "prepend_queue",
+        "append_queue",
+        "insert_into_queue",
+        "remove_from_queue",
+        "move_in_queue",
+        "show_queue",
+        "batch",
+        "subscribe",
+        "sync",
+        "metrics"
+    )
+
+    # Operations answered from the snapshot. They have to wait for the
+    # changes the same client sent before them.
+    snapshot_operations = ("status", "show_queue", "subscribe", "batch")
+
+    # Commands that don't depend on the queue, so they don't have to wait
+    # for one that is being built.
+    independent = ("pause", "seek", "_tock", "_built", "_song_ready")
+
     def __init__(self, msg_queue):
         # Read config and setup the server accordingly
         self.config = read_config()
 
         subsonic = Subsonic()
-        self.subsonic = subsonic.connection
-        self.player = PlayerThread(subsonic, msg_queue)
+        # Lookups are answered from the metadata cache when possible.
+        self.metadata = MetadataCache(
+            METADATA_CACHE_FILE,
+            self.config.getint("sonar", "metadata_ttl", fallback=86400)
+        )
+        self.subsonic = MetadataConnection(
+            self.metadata,
+            lambda: subsonic.connection
+        )
+        self.cache = CacheIndex(
+            MUSIC_CACHE_DIR,
+            CACHE_INDEX_FILE,
+            int(self.config["sonar"]["cache_limit"]) << 20
+        )
+        self.tags = TagIndex(TAG_INDEX_FILE)
+        self.player = PlayerThread(subsonic, msg_queue, self.cache, self.tags)
+        self.prefetcher = PrefetchScheduler(
+            self.player,
+            self.cache,
+            self.config.getint("sonar", "prefetch_workers", fallback=2)
+        )
+        self.syncer = SyncScheduler(
+            self.player,
+            self.cache,
+            SYNC_STATE_FILE,
+            self.config.getint("sonar", "sync_workers", fallback=4)
+        )
 
-        self.current_song = None
-        self.queue = []
+        # The current song is tracked by the queue, see current_song.
+        self.queue = PlayQueue()
+        # Queue versions start over when the server is restarted. Clients
+        # holding on to a queue send this back to tell the queues apart.
+        self.queue_id = os.urandom(8).hex()
+        self.queue_errors = []
+
+        # Subsonic lookups for building the queue run concurrently, each
+        # worker thread reusing its own keep-alive connection.
+        self.lookup_pool = ThreadPoolExecutor(
+            max_workers=self.config.getint("sonar", "lookup_workers", fallback=8)
+        )
+        # Queues are built one at a time, waiting for their lookups off the
+        # worker. Meanwhile the commands that depend on the queue are held.
+        self.build_pool = ThreadPoolExecutor(max_workers=1)
+        self.building = False
+        self.held = deque()
 
         self.shuffle = False
         self.repeat = False
 
         self.msg_queue = msg_queue
 
+        # Everything that changes the server state runs on a single worker,
+        # in the order the requests came in. Requests that only read state
+        # are answered from the latest snapshot instead.
+        self.commands = Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+
+        # The snapshot gets a new version whenever anything in it changes.
+        # While something is playing or downloading, a ticker refreshes the
+        # progress every status_interval seconds.
+        self.version = 0
+        self.ticking = False
+        self.ticker = threading.Thread(target=self._tick, daemon=True)
+        self._update_snapshot()
+
+        # Connections that get pushed a message whenever the snapshot
+        # changes, and the snapshot they were last told about.
+        self.subscribers = {}
+        self.published = self.snapshot
+
+        metrics.gauge("sonar_music_cache_bytes", lambda: self.cache.size)
+        metrics.gauge("sonar_music_cache_songs", lambda: len(self.cache))
+        metrics.gauge(
+            "sonar_music_cache_pinned_bytes", lambda: self.cache.pinned_size
+        )
+        metrics.gauge("sonar_downloads", lambda: len(self.player.downloads))
+        metrics.gauge("sonar_subscribers", lambda: len(self.subscribers))
+        metrics.gauge("sonar_queue_songs", lambda: len(self.snapshot["queue"]))
+        self.metrics_server = None
+
     def _start_server(self):
         logger.info("Starting server")
 
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind(("", int(self.config['sonar']['port'])))
-            self.socket.listen(1)
-            self.socket.setblocking(0)
-            self.socket_is_open = True
-            logger.info("Listening on port: %s" % self.config['sonar']['port'])
-        except OSError as e:
-            logger.fatal("Could not start server socket. Exiting.")
+        # Local clients use the Unix socket when there is one. TCP is for
+        # controlling the player from other machines.
+        self.sockets = []
+        if self.config.getboolean("sonar", "unix_socket", fallback=True):
+            try:
+                self.sockets.append(self._listen_unix())
+                logger.info("Listening on socket: %s" % SOCKET_FILE)
+            except OSError as e:
+                logger.warning("Could not open the Unix socket: %s" % e)
+
+        if self.config.getboolean("sonar", "tcp", fallback=True):
+            try:
+                self.sockets.append(self._listen_tcp())
+                logger.info(
+                    "Listening on port: %s" % self.config['sonar']['port']
+                )
+            except OSError as e:
+                logger.fatal("Could not start server socket. Exiting.")
+                sys.exit(1)
+
+        if not self.sockets:
+            logger.fatal("Nothing to listen on. Exiting.")
             sys.exit(1)
+        self.socket_is_open = True
 
-        self._enforce_cache_limit()
+        metrics_port = self.config.getint("sonar", "metrics_port", fallback=0)
+        if metrics_port:
+            try:
+                self.metrics_server = serve_metrics(metrics_port)
+                logger.info("Serving metrics on port: %s" % metrics_port)
+            except OSError as e:
+                logger.warning("Could not serve metrics: %s" % e)
 
-        operations = (
-            "status",
-            "play",
-            "pause",
-            "stop",
-            "previous_song",
-            "next_song",
-            "seek",
-            "repeat",
-            "shuffle",
-            "sort_queue",
-            "set_queue",
-            "prepend_queue",
-            "append_queue",
-            "remove_from_queue",
-            "show_queue"
+        self._enforce_cache_limit()
+        self.worker.start()
+        self.ticker.start()
+
+        # Sleep until either a client connects (or sends data) or the
+        # player puts something on the message queue.
+        self.selector = selectors.DefaultSelector()
+        for sock in self.sockets:
+            self.selector.register(
+                sock, selectors.EVENT_READ, self._accept_connections
+            )
+        self.selector.register(
+            self.msg_queue, selectors.EVENT_READ, self._handle_messages
         )
 
         while self.socket_is_open:
-            # Check if the queue has something for us.
-            if not self.msg_queue.empty():
-                msg = self.msg_queue.get()
-                # Figure out what to do with the queue message.
-                if msg == "EOF":
-                    # Done playing a file? Play the next in the queue.
-                    self.play_next_song()
+            for key, mask in self.selector.select():
+                callback = key.data
+                callback(key.fileobj, mask)
+
+    def _listen_tcp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", int(self.config['sonar']['port'])))
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(0)
+        return sock
+
+    def _listen_unix(self):
+        # Left behind by a server that didn't exit cleanly. The pid file
+        # makes sure it is not in use.
+        try:
+            os.remove(SOCKET_FILE)
+        except FileNotFoundError:
+            pass
 
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the server gets to control it.
+        umask = os.umask(0o177)
+        try:
+            sock.bind(SOCKET_FILE)
+        finally:
+            os.umask(umask)
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(0)
+        return sock
+
+    def _accept_connections(self, sock, mask):
+        while True:
             try:
-                # Try to get connection and address of client.
-                conn, addr = self.socket.accept()
-            except Exception as e:
-                # Client has not sent a request. Set connection to none so
-                # that we can avoid trying to handle the request later.
-                conn = None
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                # No more pending connections.
+                return
 
-            if conn:
-                # There is a connection made by the client in this iteration!
-                logger.debug("Connected by %s (pid: %s)" % addr)
-                data = conn.recv(102400)
+            if conn.family == socket.AF_UNIX:
+                addr = ("unix", conn.fileno())
+            else:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            logger.debug("Connected by %s (pid: %s)" % addr)
+            conn.setblocking(0)
+            self.selector.register(
+                ClientConnection(conn, addr),
+                selectors.EVENT_READ,
+                self._handle_client
+            )
 
+    def _handle_messages(self, msg_queue, mask):
+        msg_queue.clear_wakeup()
+        while not msg_queue.empty():
+            msg = msg_queue.get()
+            # Figure out what to do with the queue message.
+            if msg == "EOF":
+                # Done playing a file? Play the next in the queue.
+                self._run(self.play_next_song)
+            elif msg == "ADVANCED":
+                # The player moved on to the preloaded song by itself.
+                self._run(self._advanced)
+            elif msg == "SNAPSHOT":
+                # The worker changed something. Tell the subscribers.
+                self._publish()
+            elif isinstance(msg, tuple) and msg[0] == "APPLIED":
+                # The worker caught up with a client's changes.
+                self._answer_held(msg[1])
+
+    def _handle_client(self, client, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(65536)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b""
+
+            if data == b"":
+                # Client hung up.
+                self._close_client(client)
+                return
+
+            if data:
                 try:
-                    # Try to handle the request.
-                    data = str(data.decode("utf-8"))
-                    request = json.loads(data)
-
-                    log_info = json.dumps({"operation": request["operation"]})
-                    logger.info("Got request: %s" % log_info)
-                    if data != log_info:
-                        logger.debug("Full request: %s" % data)
-
-                    if "operation" in request:
-                        if request['operation'] in operations:
-                            # Success. Carry out the operation.
-                            ret = {
-                                "code": "OK"
-                            }
-
-                            operation = request["operation"]
-                            if operation == "status":
-                                ret['current_song'] = self.status()
-
-                            elif operation == "play":
-                                queue_index = request.get("queue_index", None)
-                                threading.Thread(
-                                    target=self.play,
-                                    args=(queue_index,)
-                                ).start()
-
-                            elif operation in ["pause"]:
-                                threading.Thread(
-                                    target=self.pause
-                                ).start()
-
-                            elif operation == "stop":
-                                threading.Thread(
-                                    target=self.stop
-                                ).start()
-
-                            elif operation == "previous_song":
-                                threading.Thread(
-                                    target=self.play_previous_song
-                                ).start()
-
-                            elif operation == "next_song":
-                                threading.Thread(
-                                    target=self.play_next_song
-                                ).start()
-
-                            elif operation == "shuffle":
-                                threading.Thread(
-                                    target=self.shuffle_queue
-                                ).start()
-
-                            elif operation == "sort_queue":
-                                threading.Thread(
-                                    target=self.sort_queue
-                                ).start()
-
-                            elif operation == "repeat":
-                                value = request.get("value", None)
-                                threading.Thread(
-                                    target=self.set_repeat,
-                                    args=(value,)
-                                ).start()
-
-                            elif operation == "seek" and \
-                                    "timedelta" in request:
-                                threading.Thread(
-                                    target=self.seek,
-                                    args=(request["timedelta"],)
-                                ).start()
-
-                            elif operation == "set_queue" and \
-                                    "data" in request:
-                                threading.Thread(
-                                    target=self.set_queue,
-                                    args=(request["data"],)
-                                ).start()
-
-                            elif operation == "prepend_queue" and \
-                                    "data" in request:
-                                threading.Thread(
-                                    target=self.prepend_queue,
-                                    args=(request["data"],)
-                                ).start()
-
-                            elif operation == "append_queue" and \
-                                    "data" in request:
-                                threading.Thread(
-                                    target=self.append_queue,
-                                    args=(request["data"],)
-                                ).start()
-
-                            elif operation == "remove_from_queue" and \
-                                    "data" in request:
-                                threading.Thread(
-                                    target=self.remove_from_queue,
-                                    args=(request["data"],)
-                                ).start()
-
-                            elif operation == "show_queue":
-                                ret.update({
-                                    'queue': self.queue,
-                                    'current_song': self.current_song,
-                                    "player_state": self.player.player_state()
-                                })
-
-                        else:
-                            # The request operation was not found in the list
-                            # of permitted operations. Go bananas.
-                            raise Exception("Operation not permitted.")
-
-                    else:
-                        # "operation" not in request. You know the drill.
-                        raise Exception("No operation given.")
-
-                    # Send the response to the client.
-                    response = json.dumps(ret)
-                    conn.sendall(response.encode("utf-8"))
-                    conn.close()
-
-                    log_info = json.dumps({"code": ret["code"]})
-                    logger.info("Returning response: %s" % log_info)
-                    if response != log_info:
-                        logger.debug("Full Response: %s" % response)
+                    requests = client.feed(data)
+                except Exception as e:
+                    logger.error("Dropping client %s: %s" % (client.addr, e))
+                    self._close_client(client)
+                    return
+
+                for request in requests:
+                    self._dispatch(client, request)
+                    if client.closed:
+                        # Dropped while answering, e.g. as a slow subscriber.
+                        return
+
+        self._flush_client(client)
+
+    def _dispatch(self, client, request):
+        """
+        Answers a request, unless it reads state that changes the client
+        sent before it may not have made yet. Such requests are held until
+        the worker gets to a marker queued behind those changes.
+        """
+        if client.waiting:
+            # Keep the answers in order.
+            client.held.append(request)
+            return
+
+        if client.unapplied and isinstance(request, dict) and \
+                request.get("operation") in self.snapshot_operations:
+            client.unapplied = False
+            client.waiting = True
+            client.held.append(request)
+            self._run(self._applied, client)
+            return
+
+        self._respond(client, request)
+
+    def _applied(self, client):
+        self.msg_queue.put(("APPLIED", client))
+
+    def _answer_held(self, client):
+        if client.closed:
+            return
+
+        client.waiting = False
+        held = list(client.held)
+        client.held.clear()
+        for request in held:
+            self._dispatch(client, request)
+            if client.closed:
+                return
+        self._flush_client(client)
+
+    def _respond(self, client, request):
+        start = time.perf_counter()
+        # Keeps junk out of the metric labels.
+        operation = "unknown"
+
+        try:
+            if not isinstance(request, dict):
+                raise Exception("Requests must be JSON objects.")
+            if request.get("operation") in self.operations:
+                operation = request["operation"]
+
+            # Try to handle the request.
+            log_info = json.dumps({"operation": request.get("operation")})
+            logger.info("Got request: %s" % log_info)
+            logger.debug("Full request: %s" % json.dumps(request))
+
+            def run(target, *args):
+                client.unapplied = True
+                self._run(target, *args)
+
+            if request.get("operation") == "subscribe":
+                ret = self._subscribe(client, request)
+            else:
+                ret = self._handle_request(request, run)
+
+        except Exception as e:
+            # Exception handler for request handler logic.
+            ret = {
+                "code": "ERROR",
+                "message": str(e)
+            }
+            logger.critical(json.dumps(ret))
+            metrics.inc("sonar_request_errors_total", operation=operation)
+
+        # Send the response to the client.
+        client.send(ret)
+        metrics.observe(
+            "sonar_request_seconds",
+            time.perf_counter() - start,
+            operation=operation
+        )
 
+        if client in self.subscribers and operation == "subscribe":
+            # Start the stream off with the current state. Whatever the
+            # client had queued before subscribing doesn't make it slow.
+            self._push(client, ["status"], self.snapshot, initial=True)
 
-                except Exception as e:
-                    # Exception handler for request handler logic.
-                    ret = {
-                        "code": "ERROR",
-                        "message": str(e)
-                    }
-                    logger.critical(json.dumps(ret))
-                    raise
+        logger.info("Returning response: %s" % json.dumps({
+            "code": ret["code"]
+        }))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Full Response: %s" % json.dumps(ret))
+
+    def _flush_client(self, client):
+        if client.closed:
+            return
+        try:
+            flushed = client.flush()
+        except OSError:
+            self._close_client(client)
+            return
+
+        if flushed and client.close_when_flushed:
+            self._close_client(client)
+            return
+
+        events = selectors.EVENT_READ
+        if not flushed:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(client).events != events:
+            self.selector.modify(client, events, self._handle_client)
+
+    def _close_client(self, client):
+        if client.closed:
+            return
+        self.subscribers.pop(client, None)
+        self.selector.unregister(client)
+        client.close()
+
+    def _subscribe(self, client, request):
+        if not client.framed:
+            raise Exception("Subscribing needs a framed connection.")
+
+        interval = request.get("interval")
+        if interval is None:
+            interval = self.config.getfloat("sonar", "status_interval", fallback=1)
+
+        self.subscribers[client] = {
+            "interval": float(interval),
+            "progress_sent": 0
+        }
+        logger.debug("Client %s subscribed" % (client.addr,))
+        return {"code": "OK"}
+
+    def _publish(self):
+        snapshot = self.snapshot
+        previous = self.published
+        if previous["version"] == snapshot["version"]:
+            return
+        self.published = snapshot
+
+        def song_id(state):
+            if state["status"]:
+                return state["status"]["song"]["id"]
+
+        events = []
+        if song_id(snapshot) != song_id(previous) or \
+                snapshot["current_song"] != previous["current_song"]:
+            events.append("track")
+        if snapshot["player_state"] != previous["player_state"]:
+            events.append("state")
+        if snapshot["queue_version"] != previous["queue_version"] or \
+                snapshot["shuffle"] != previous["shuffle"] or \
+                snapshot["repeat"] != previous["repeat"]:
+            events.append("queue")
+        if snapshot["status"] != previous["status"] and not events:
+            events.append("progress")
+
+        for client in list(self.subscribers):
+            self._push(client, events, snapshot)
+
+    def _push(self, client, events, snapshot, initial=False):
+        subscription = self.subscribers[client]
+        now = time.monotonic()
+        if events == ["progress"] and \
+                now - subscription["progress_sent"] < subscription["interval"]:
+            # Only progress changed and this subscriber got one recently.
+            return
+        subscription["progress_sent"] = now
+
+        if len(client.out) > 256 and not initial:
+            # The subscriber is not reading. Don't buffer forever.
+            logger.warning("Dropping slow subscriber %s" % (client.addr,))
+            self._close_client(client)
+            return
+
+        client.send({
+            "events": events,
+            "version": snapshot["version"],
+            "status": snapshot["status"]
+        })
+        self._flush_client(client)
+
+    def _handle_request(self, request, run=None):
+        """
+        Carries out a request and returns the response. Operations that
+        change state are handed to `run`, which by default queues them for
+        the worker.
+        """
+        if run is None:
+            run = self._run
+
+        if "operation" not in request:
+            # "operation" not in request. You know the drill.
+            raise Exception("No operation given.")
+
+        if request["operation"] not in self.operations:
+            # The request operation was not found in the list
+            # of permitted operations. Go bananas.
+            raise Exception("Operation not permitted.")
+
+        # Success. Carry out the operation.
+        ret = {
+            "code": "OK"
+        }
+
+        operation = request["operation"]
+        if operation == "subscribe":
+            raise Exception("Can't subscribe from within a batch.")
+
+        elif operation == "batch" and "operations" in request:
+            # Collect the state changes of all operations and apply them in
+            # one go, so that no other request can get in between.
+            calls = []
+            ret["results"] = [
+                self._handle_request(
+                    sub_request,
+                    run=lambda target, *args: calls.append((target, args))
+                )
+                for sub_request in request["operations"]
+                if sub_request.get("operation") != "batch"
+            ]
+            run(self._run_batch, calls)
+
+        elif operation == "status":
+            ret['current_song'] = self.status()
+            ret['version'] = self.snapshot["version"]
+
+        elif operation == "play":
+            queue_index = request.get("queue_index", None)
+            run(self.play, queue_index)
+
+        elif operation in ["pause"]:
+            run(self.pause)
+
+        elif operation == "stop":
+            run(self.stop)
+
+        elif operation == "previous_song":
+            run(self.play_previous_song)
+
+        elif operation == "next_song":
+            run(self.play_next_song)
+
+        elif operation == "shuffle":
+            run(self.shuffle_queue, request.get("seed", None))
+
+        elif operation == "unshuffle_queue":
+            run(self.unshuffle_queue)
+
+        elif operation == "sort_queue":
+            run(self.sort_queue)
+
+        elif operation == "repeat":
+            value = request.get("value", None)
+            run(self.set_repeat, value)
+
+        elif operation == "seek" and \
+                "timedelta" in request:
+            run(self.seek, request["timedelta"])
+
+        elif operation == "set_queue" and \
+                "data" in request:
+            run(self.set_queue, request["data"])
+
+        elif operation == "prepend_queue" and \
+                "data" in request:
+            run(self.prepend_queue, request["data"])
 
+        elif operation == "append_queue" and \
+                "data" in request:
+            run(self.append_queue, request["data"])
+
+        elif operation == "insert_into_queue" and \
+                "data" in request:
+            run(
+                self.insert_into_queue,
+                request.get("position", 0),
+                request["data"]
+            )
+
+        elif operation == "remove_from_queue" and \
+                "data" in request:
+            run(self.remove_from_queue, request["data"])
+
+        elif operation == "move_in_queue" and \
+                "source" in request and "destination" in request:
+            run(self.move_in_queue, request["source"], request["destination"])
+
+        elif operation == "show_queue":
+            ret.update(self._show_queue(request, self.snapshot))
+
+        elif operation == "sync":
+            action = request.get("action", "status")
+            if action == "start" and "data" in request:
+                # Looking up thousands of songs would hold up the worker.
+                threading.Thread(
+                    target=self._start_sync,
+                    args=(request["data"],),
+                    daemon=True
+                ).start()
+            elif action == "cancel":
+                self.syncer.cancel()
+            elif action == "clear":
+                self.syncer.clear()
+            elif action != "status":
+                raise Exception("Unknown sync action: %s" % action)
+            ret["sync"] = self.syncer.status()
+
+        elif operation == "metrics":
+            ret["metrics"] = metrics.snapshot()
+
+        return ret
+
+    def _show_queue(self, request, snapshot):
+        """
+        Answers show_queue. Clients that send the queue_version they have
+        get "unchanged" or the changes since then instead of the whole
+        queue. A window ({"start": n, "count": n} or {"around": n}) returns
+        only part of the queue, and fields limits what is sent per song.
+        """
+        songs = snapshot["queue"].songs()
+        ret = {
+            'queue_errors': snapshot["queue_errors"],
+            'current_song': snapshot["current_song"],
+            "player_state": snapshot["player_state"],
+            "version": snapshot["version"],
+            "queue_id": self.queue_id,
+            "queue_version": snapshot["queue_version"],
+            "cache_version": self.cache.version,
+            "length": len(songs)
+        }
+
+        fields = request.get("fields")
+        version = None
+        if request.get("queue_id") == self.queue_id:
+            version = request.get("queue_version")
+
+        def project(song):
+            if fields:
+                return {field: song.get(field) for field in fields}
+            return song
+
+        start, end = 0, len(songs)
+        window = request.get("window")
+        if window:
+            if "around" in window:
+                current = snapshot["current_song"] or 0
+                start = max(current - int(window["around"]), 0)
+                end = current + int(window["around"]) + 1
             else:
-                # Wait for a little before starting to listen
-                # to socket connection again.
-                time.sleep(.150)
+                start = max(int(window.get("start", 0)), 0)
+                end = start + int(window.get("count", len(songs)))
+            ret["offset"] = start
+
+        elif version == snapshot["queue_version"]:
+            ret["unchanged"] = True
+            if request.get("cache_version") != self.cache.version:
+                ret["cached"] = [song["id"] in self.cache for song in songs]
+            return ret
+
+        else:
+            changes = snapshot["queue_history"].since(version)
+            if changes is not None:
+                ret["changes"] = [
+                    self._project_change(change, project)
+                    for change in changes
+                ]
+                ret["cached"] = [song["id"] in self.cache for song in songs]
+                return ret
+
+        # The whole queue, or the window of it. Which songs are cached is
+        # sent along, so the client doesn't have to look in the music cache.
+        songs = songs[start:end]
+        ret.update({
+            "queue": [project(song) for song in songs],
+            "entries": snapshot["queue"].entry_ids()[start:end],
+            "cached": [song["id"] in self.cache for song in songs]
+        })
+        return ret
+
+    def _project_change(self, change, project):
+        if change[0] == "insert":
+            kind, position, entries = change
+            return [kind, position, [
+                [entry_id, project(song)] for entry_id, song in entries
+            ]]
+        return list(change)
+
+    def _run(self, target, *args):
+        self.commands.put((target, args, time.perf_counter()))
+
+    def _work(self):
+        while True:
+            if self.held and not self.building:
+                target, args, queued = self.held.popleft()
+            else:
+                target, args, queued = self.commands.get()
+            if target is None:
+                return
+
+            if self.building and target.__name__ not in self.independent:
+                # Carried out in order once the queue is built.
+                self.held.append((target, args, queued))
+                continue
+
+            try:
+                target(*args)
+            except Exception:
+                logger.exception("Operation failed: %s" % target.__name__)
+
+            self._update_snapshot()
+            # Including the wait for the worker, as that's what clients see.
+            metrics.observe(
+                "sonar_command_seconds",
+                time.perf_counter() - queued,
+                command=target.__name__
+            )
+
+    def _tick(self):
+        interval = self.config.getfloat("sonar", "status_interval", fallback=1)
+        while True:
+            time.sleep(interval)
+            if self.ticking:
+                # The last tick is still waiting for the worker.
+                continue
+            if self.snapshot["player_state"] == "Playing" or \
+                    self.player.downloads:
+                self.ticking = True
+                self._run(self._tock)
+
+    def _tock(self):
+        # The worker refreshes the snapshot after this. The next song may
+        # have finished downloading since it was last tried to preload.
+        self.ticking = False
+        self._preload()
+
+    def _update_snapshot(self):
+        self.player.refresh()
+        state = {
+            # Put together when a client asks for it. Shared until the
+            # queue changes, like the history.
+            "queue": self.queue.view(),
+            "queue_version": self.queue.version,
+            "queue_history": self.queue.history(),
+            "queue_errors": list(self.queue_errors),
+            "current_song": self.current_song,
+            "shuffle": self.shuffle,
+            "repeat": self.repeat,
+            "player_state": self.player.state,
+            "progress": self.player.last_progress
+        }
+        state["status"] = self._status(state)
+
+        snapshot = getattr(self, "snapshot", {})
+        changed = state != {
+            k: v for k, v in snapshot.items() if k != "version"
+        }
+        if changed:
+            self.version += 1
+        state["version"] = self.version
+
+        # Replaced as a whole, so readers always see a consistent state.
+        self.snapshot = state
+
+        if changed:
+            self.msg_queue.put("SNAPSHOT")
+
+    def _run_batch(self, calls):
+        for i, (target, args) in enumerate(calls):
+            target(*args)
+            if self.building:
+                # The rest of the batch goes first once the queue is built.
+                self.held.appendleft(
+                    (self._run_batch, (calls[i + 1:],), time.perf_counter())
+                )
+                return
 
     def _stop_server(self):
         # Stop players and threads and whatnot
+        self.commands.put((None, None, None))
         self.player.quit()
+        self.lookup_pool.shutdown(wait=False)
+        self.build_pool.shutdown(wait=False)
+        self.cache.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+
+        for sock in self.sockets:
+            if sock.family == socket.AF_UNIX:
+                try:
+                    os.remove(SOCKET_FILE)
+                except OSError:
+                    pass
+            sock.close()
 
     def _touch_song(self, s_id, times=None):
         file_path = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % s_id)
-        with open(file_path, "a"):
+        if self.cache.touch(s_id):
+            # Keep the mtime up to date too, in case the index has to be
+            # rebuilt from the directory.
             os.utime(file_path, times)
 
         self._enforce_cache_limit()
 
     def _enforce_cache_limit(self):
-        cached_songs = [
-            os.path.join(MUSIC_CACHE_DIR, f)
-            for f in os.listdir(MUSIC_CACHE_DIR)
-            if f.endswith(".mp3")
+        self.cache.enforce_limit()
+
+    def _lookup_all(self, kind, items, errors):
+        """
+        Looks up items concurrently and returns the results in the same
+        order. Lookups that fail are reported in errors and left out.
+        """
+        lookup = {
+            "artist": self.subsonic.getArtist,
+            "album": self.subsonic.getAlbum,
+            "song": self.subsonic.getSong,
+            "playlist": self.subsonic.getPlaylist,
+        }[kind]
+        futures = [
+            (item, self.lookup_pool.submit(lookup, item["id"]))
+            for item in items
         ]
-        cached_songs.sort(key=lambda f: os.stat(f).st_mtime, reverse=True)
-        cache_size = sum(os.path.getsize(f) for f in cached_songs) >> 20
 
-        if cache_size > int(self.config["sonar"]["cache_limit"]):
-            logger.info("Enforcing cache limit of %d Mb" % self.config["sonar"]["cache_limit"])
+        def results():
+            for item, future in futures:
+                try:
+                    yield future.result()
+                except Exception as e:
+                    logger.warning("Could not find %s: %s" % (kind, item["id"]))
+                    errors.append({
+                        "kind": kind,
+                        "id": item["id"],
+                        "message": str(e)
+                    })
+
+        # Return a generator so that callers can submit several kinds of
+        # lookups before waiting for any of them.
+        return results()
+
+    def _build_queue(self, data, apply):
+        """
+        Looks up the songs in data on the build pool and hands them to apply
+        on the worker. The worker goes on with other commands meanwhile,
+        holding back the ones that depend on the queue.
+        """
+        def build():
+            errors = []
+            with metrics.timer("sonar_build_queue_seconds"):
+                queue = self._lookup_songs(data, errors)
+            return queue, errors
+
+        self.building = True
+        future = self.build_pool.submit(build)
+        future.add_done_callback(
+            lambda future: self._run(self._built, future, data, apply)
+        )
+
+    def _built(self, future, data, apply):
+        self.building = False
+        queue, self.queue_errors = future.result()
+
+        if "artist" in data and data["artist"] or \
+                "album" in data and data["album"]:
+            queue = self._sort_queue(queue)
+
+        apply(queue)
 
-        while cache_size > int(self.config["sonar"]["cache_limit"]):
-            oldest_song = cached_songs.pop()
-            os.remove(oldest_song)
-            cache_size = sum(os.path.getsize(f) for f in cached_songs) >> 20
+    def _start_sync(self, data):
+        errors = []
+        songs = self._lookup_songs(data, errors)
+        self.syncer.add(songs, errors)
 
-    def _build_queue(self, data):
+    def _lookup_songs(self, data, errors):
+        """
+        Returns the songs of the artists, albums, songs and playlists in
+        data. Lookups that fail are reported in errors.
+        """
         queue = []
         # order_by_track_number = False
         artists = data.get("artist", [])
-        albums = data.get("album", [])
+        albums = list(data.get("album", []))
         songs = data.get("song", [])
         playlists = data.get("playlists", [])
 
-        if len(artists) > 0:
-            # order_by_track_number = True
-            for a in artists:
-                try:
-                    result = self.subsonic.getArtist(a["id"])
-                except:
-                    logger.warning("Could not find artist: %s" % a["id"])
-                    continue
-
-                artist = {}
-                if "artist" in result:
-                    artist = result["artist"]
-
-                if artist and not "album" in artist:
-                    artist = {
-                        "album": [artist]
-                    }
-
-                for album in artist["album"]:
-                    albums.append({"id": album["id"]})
-
-        if len(albums) > 0:
-            # order_by_track_number = True
-            for a in albums:
-                try:
-                    result = self.subsonic.getAlbum(a["id"])
-                except:
-                    logger.warning("Could not find album: %s" % a["id"])
-                    continue
+        for result in self._lookup_all("artist", artists, errors):
+            artist = {}
+            if "artist" in result:
+                artist = result["artist"]
+
+            if artist and not "album" in artist:
+                artist = {
+                    "album": [artist]
+                }
 
-                album = {}
-                if "album" in result:
-                    album = result["album"]
+            for album in artist.get("album", []):
+                albums.append({"id": album["id"]})
 
-                if not "song" in album:
-                    album["song"] = []
-                elif not isinstance(album["song"], list):
-                    album["song"] = [album["song"]]
+        album_results = self._lookup_all("album", albums, errors)
+        song_results = self._lookup_all("song", songs, errors)
+        playlist_results = self._lookup_all("playlist", playlists, errors)
 
-                queue += album["song"]
+        for result in album_results:
+            album = result.get("album", {})
+            album_songs = album.get("song", [])
+            if not isinstance(album_songs, list):
+                album_songs = [album_songs]
 
-        if len(songs) > 0:
-            for s in songs:
-                try:
-                    result = self.subsonic.getSong(s["id"])
-                except:
-                    logger.warning("Could not find song: %s" % s["id"])
-                    continue
+            queue += album_songs
 
-                if "song" in result:
-                    queue.append(result["song"])
+        for result in song_results:
+            if "song" in result:
+                queue.append(result["song"])
 
-        if len(playlists) > 0:
-            for p in playlists:
-                try:
-                    result = self.subsonic.getPlaylist(p["id"])
-                except:
-                    logger.warning("Could not find playlist: %s" % p["id"])
-                    continue
+        for result in playlist_results:
+            entries = result.get("playlist", {}).get("entry", [])
+            if not isinstance(entries, list):
+                entries = [entries]
 
-                logger.critical(result)
-                songs = result.get("playlist", {}).get("entry", [])
-                queue += songs
+            queue += entries
 
         return queue
 
+    @property
+    def current_song(self):
+        """
+        Queue index of the current song, or None.
+        """
+        return self.queue.current_position
+
+    @current_song.setter
+    def current_song(self, queue_index):
+        self.queue.current_position = queue_index
+
     def _sort_queue(self, queue):
         try:
-            ret = sorted(
-                queue,
-                key=itemgetter("artistId", "albumId", "discNumber", "track")
-            )
+            ret = sorted(queue, key=self.sort_key)
             self.shuffle = False
         except:
             ret = queue
@@ -387,7 +1109,7 @@ class SonarServer(object):
         logger.warning("Could not determine previous song.")
         return False, ""
 
-    def _determine_next_song(self):
+    def _determine_next_song(self, quiet=False):
         if self.queue and isinstance(self.current_song, int):
             queue_index = self.current_song+1
             next_song = None
@@ -400,18 +1122,56 @@ class SonarServer(object):
             if isinstance(next_song, int):
                 return True, next_song
 
-        logger.warning("Could not determine next song in queue.")
+        if not quiet:
+            logger.warning("Could not determine next song in queue.")
         return False, ""
 
-    def _prefetch_next_song(self):
+    def _upcoming_songs(self, depth):
+        """
+        Returns the queue indexes of the current song and the depth songs
+        after it, in the order they are going to be played.
+        """
+        if not self.queue:
+            return []
+
+        start = self.current_song if isinstance(self.current_song, int) else 0
+        indexes = []
+        for queue_index in range(start, start + depth + 1):
+            if queue_index >= len(self.queue):
+                if not self.repeat:
+                    break
+                queue_index %= len(self.queue)
+            if queue_index in indexes:
+                # Wrapped all the way around a short queue.
+                break
+            indexes.append(queue_index)
+        return indexes
+
+    def _preload(self):
+        success, next_song = self._determine_next_song(quiet=True)
+        self.player.preload(self.queue[next_song] if success else None)
+
+    def _advanced(self):
         success, next_song = self._determine_next_song()
-        if success:
-            s_id = self.queue[next_song]["id"]
-            logger.info("Prefetching next song: %s" % s_id)
-            self.player._get_song(s_id)
-            self._enforce_cache_limit()
+        if success and \
+                str(self.queue[next_song]["id"]) == self.player.playing:
+            self.current_song = next_song
+            self._touch_song(self.player.playing)
+            self._prefetch()
         else:
-            return False, "Could not prefetch next song."
+            # The queue changed under the player. Do it the slow way.
+            self.play_next_song()
+
+    def _prefetch(self):
+        self._preload()
+        if not self.config.getboolean("sonar", "prefetch"):
+            return
+
+        depth = self.config.getint("sonar", "prefetch_depth", fallback=1)
+        self.prefetcher.schedule(
+            self.queue[queue_index]
+            for queue_index in self._upcoming_songs(depth)
+        )
 
     def _play_song(self, queue_index):
         if not self.queue:
@@ -423,14 +1183,23 @@ class SonarServer(object):
                 queue_index < len(self.queue):
             self.current_song = queue_index
             s_id = self.queue[queue_index]["id"]
-            self.player.play_song(s_id)
+            download = self.player.play_song(self.queue[queue_index])
+            if download is not None:
+                # Played from the worker once enough of it is in. Meanwhile
+                # the worker carries on with other commands.
+                download.when(
+                    lambda: self._run(self._song_ready, download),
+                    self.player.buffer_size()
+                )
             self._touch_song(s_id)
-            if self.config["sonar"]["prefetch"]:
-                threading.Thread(target=self._prefetch_next_song).start()
+            self._prefetch()
             return True, ""
 
         return False, "Index not in queue: %s" % queue_index
 
+    def _song_ready(self, download):
+        self.player.load_song(download)
+
     def play(self, queue_index=None):
         if not self.queue:
             # No queue. Return sadness.
@@ -490,177 +1259,449 @@ class SonarServer(object):
         else:
             self.repeat = value
 
+        self._prefetch()
+
     def seek(self, timedelta):
         if not self.player.is_stopped():
             self.player.seek(timedelta)
 
     def set_queue(self, data):
         self.stop()
-        self.queue = []
-
-        queue = self._build_queue(data)
+        self.queue.clear()
+        self._build_queue(data, self._set_queue)
 
-        if "artist" in data and data["artist"] or \
-                "album" in data and data["album"]:
-            queue = self._sort_queue(queue)
-
-        self.queue = queue
-
-        if self.config["sonar"]["prefetch"]:
-            s_id = queue[0]["id"]
-            # logger.info("Getting first song in queue: %s" % s_id)
-            self.player._get_song(s_id)
-            self._enforce_cache_limit()
+    def _set_queue(self, queue):
+        self.queue.extend(queue)
+        self._prefetch()
 
     def prepend_queue(self, data):
-        queue = self._build_queue(data)
+        self._build_queue(data, self._prepend_queue)
 
-        if "artist" in data and data["artist"] or \
-                "album" in data and data["album"]:
-            queue = self._sort_queue(queue)
+    def _prepend_queue(self, queue):
+        self._insert_queue(0, queue)
 
-        self.queue = queue + self.queue
+    def append_queue(self, data):
+        self._build_queue(data, self._append_queue)
 
-        if self.queue and not self.current_song:
+    def _append_queue(self, queue):
+        self.queue.extend(queue)
+
+        if self.queue and self.current_song is None:
             self.current_song = 0
 
-    def append_queue(self, data):
-        queue = self._build_queue(data)
+        self._prefetch()
 
-        if "artist" in data and data["artist"] or \
-                "album" in data and data["album"]:
-            queue = self._sort_queue(queue)
+    def insert_into_queue(self, position, data):
+        if isinstance(position, int):
+            self._build_queue(
+                data,
+                lambda queue: self._insert_queue(position, queue)
+            )
 
-        self.queue += queue
+    def _insert_queue(self, position, queue):
+        self.queue.insert(position, queue)
 
-        if self.queue and not self.current_song:
+        if self.queue and self.current_song is None:
             self.current_song = 0
 
+        self._prefetch()
+
     def remove_from_queue(self, data):
         if isinstance(data, list) and len(data) == 1 and data[0] == -1:
-            self.queue = []
+            self.queue.clear()
             self.stop()
         else:
-            logger.warning("Removing from queue is not implement yet.")
+            # If the current song goes, the one before it becomes current,
+            # so the one after it is played next.
+            self.queue.remove(
+                queue_index for queue_index in data
+                if isinstance(queue_index, int)
+            )
+        self._prefetch()
 
-    def shuffle_queue(self):
-        if self.queue:
-            if self.current_song:
-                current_song_obj = self.queue.pop(self.current_song)
+    def move_in_queue(self, source, destination):
+        if isinstance(source, int) and isinstance(destination, int) and \
+                0 <= source < len(self.queue):
+            self.queue.move(source, destination)
+            self._prefetch()
 
-            shuffle(self.queue)
+    def shuffle_queue(self, seed=None):
+        if self.queue:
+            # The current song is moved to the top. The same seed gives the
+            # same order.
+            seed = self.queue.shuffle(seed)
+            logger.debug("Shuffled the queue with seed: %s" % seed)
             self.shuffle = True
 
-            if self.current_song:
-                self.queue = [current_song_obj] + self.queue
-                self.current_song = 0
+            self._prefetch()
 
-    def sort_queue(self):
-        if self.queue:
-            if self.current_song:
-                current_song_obj = self.queue[self.current_song]
+    def unshuffle_queue(self):
+        if self.queue.shuffled:
+            self.queue.unshuffle()
+            self.shuffle = False
 
-            self.queue = self._sort_queue(self.queue)
+            self._prefetch()
 
+    def sort_queue(self):
+        if self.queue:
             try:
-                self.current_song = self.queue.index(current_song_obj)
-            except:
-                self.current_song = 0
+                self.queue.sort(self.sort_key)
+                self.shuffle = False
+            except Exception:
+                logger.warning("Could not sort the queue.")
+
+            self._prefetch()
 
     def status(self):
-        if not isinstance(self.current_song, int):
+        return self.snapshot["status"]
+
+    def _status(self, state):
+        current_song = state["current_song"]
+        if not isinstance(current_song, int) or not state["queue"]:
             return None
 
-        downloading = False
-        if self.queue[self.current_song]["id"] in self.player.download_queue:
-            downloading = True
+        song = self.queue[current_song]
+        download = self.player.download_progress(song["id"])
 
         ret = {
-            "queue_length": len(self.queue),
-            "queue_position": self.current_song+1,
-            "song": self.queue[self.current_song],
-            "player_state": self.player.player_state(),
-            "progress": self.player.progress(),
-            "shuffle": self.shuffle,
-            "repeat": self.repeat,
-            "downloading": downloading
+            "queue_length": len(state["queue"]),
+            "queue_position": current_song+1,
+            "song": song,
+            "player_state": state["player_state"],
+            "progress": state["progress"],
+            "shuffle": state["shuffle"],
+            "repeat": state["repeat"],
+            "downloading": download is not None,
+            "download": download
         }
 
         return ret
 
 
 class PlayerThread(threading.Thread):
-    def __init__(self, subsonic, msg_queue):
+    def __init__(self, subsonic, msg_queue, cache, tags):
         # Read config and setup the player accordingly
         self.config = read_config()
+        self.cache = cache
+        self.tags = tags
+
+        # Downloads in flight, by song id.
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
+        # Room for a download per prefetch and sync worker, and for the
+        # song being played and the one before it while it is cancelled.
+        # Streams only ever feed the song being played.
+        self.download_pool = ThreadPoolExecutor(
+            max_workers=self.config.getint(
+                "sonar", "prefetch_workers", fallback=2
+            ) + self.config.getint("sonar", "sync_workers", fallback=4) + 2
+        )
+        self.feed_pool = ThreadPoolExecutor(max_workers=2)
+        # Interrupted downloads are resumed, but not forever.
+        remove_stale_parts(MUSIC_CACHE_DIR)
 
-        self.download_queue = []
+        # Bandwidth budget shared by all prefetches, in KiB/s.
+        self.prefetch_limiter = None
+        prefetch_rate = self.config.getint("sonar", "prefetch_rate", fallback=0)
+        if prefetch_rate > 0:
+            self.prefetch_limiter = RateLimiter(prefetch_rate << 10)
 
         subsonic = Subsonic()
         self.subsonic = subsonic.connection
-        self.mplayer = MPlayer(
-            args=("-really-quiet", "-msglevel", "global=6", "-nolirc")
-        )
-        self.mplayer.stdout.connect(self._handle_data)
+        self.mplayer = self._start_mplayer()
+
+        # In gapless mode the next song is kept loaded (and paused) in a
+        # second MPlayer, which takes over the moment the current song ends.
+        self.gapless = self.config.getboolean("sonar", "gapless", fallback=False)
+        self.standby = self._start_mplayer() if self.gapless else None
+        # Ids of the songs in the players.
+        self.playing = None
+        self.preloaded = None
+        self.switch_lock = threading.RLock()
+        # (song, download, start time) of the song waiting for its download
+        # before it can be played, see play_song().
+        self.loading = None
+        # The download play_song() claimed, released when another song is
+        # played.
+        self.download = None
 
         self.msg_queue = msg_queue
 
+        # Last known state, see refresh().
+        self.state = "Stopped"
+        self.last_progress = None
+
         super(PlayerThread, self).__init__()
 
-    def _handle_data(self, data):
+    def _start_mplayer(self):
+        player = MPlayer(
+            args=("-really-quiet", "-msglevel", "global=6", "-nolirc")
+        )
+        player.stdout.connect(lambda data: self._handle_data(data, player))
+        return player
+
+    def _handle_data(self, data, player=None):
         # Handle the stdout stream coming back from MPlayer.
         if data.startswith('EOF code:'):
             if data.split(": ")[1] == "1":
                 # EOF Code: 1 means that the song finished playing
                 # by itself. Therefore we want to try to play the
                 # next song in the queue.
+                with self.switch_lock:
+                    if player is not None and player is not self.mplayer:
+                        # Not the player we are listening to.
+                        return
+                    if self._switch():
+                        # Already playing the next song. The server only
+                        # has to catch up.
+                        self.msg_queue.put("ADVANCED")
+                        return
                 self.msg_queue.put("EOF")
 
-    def _get_stream(self, song_id):
-        return self.subsonic.stream(song_id)
-
-    def _get_song(self, song_id):
+    def _switch(self):
+        """
+        Starts the preloaded song, making the standby player the active one.
+        Called with the switch lock held.
+        """
+        if self.preloaded is None:
+            return False
+
+        self.standby.pause()
+        self.mplayer, self.standby = self.standby, self.mplayer
+        self.playing, self.preloaded = self.preloaded, None
+        return True
+
+    def preload(self, song):
+        """
+        Loads song into the standby player, if in gapless mode and the song
+        is in the cache. Songs that are still downloading are left to
+        play_song, as is everything when song is None.
+        """
+        if not self.gapless:
+            return
+
+        song_id = str(song["id"]) if song else None
+        song_file = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % song_id)
+        with self.switch_lock:
+            if song_id == self.preloaded:
+                return
+            if self.preloaded is not None:
+                self.standby.stop()
+                self.preloaded = None
+            if song_id is None or not os.path.exists(song_file):
+                return
+
+            logger.debug("Preloading song with id: %s" % song_id)
+            # Loaded files stay paused until the song is switched to, see
+            # play_song().
+            self.standby.loadfile(song_file)
+            self.preloaded = song_id
+
+    def _get_stream(self, song_id, offset=0):
+        # Until the response headers are in.
+        with metrics.timer("sonar_subsonic_seconds", endpoint="stream"):
+            return open_stream(self.subsonic, song_id, offset)
+
+    def _start_download(self, song, prefetch=False):
+        """
+        Returns the Download of a song, starting it in the background unless
+        it is already in flight. Returns None if the song is cached.
+        """
+        song_id = str(song["id"])
         song_file = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % song_id)
-        if os.path.exists(song_file):
-            logger.info("The song with id %s was found in the cache" % song_id)
-            # Check if file already exists in cache
+        with self.downloads_lock:
+            if song_id in self.downloads:
+                # Someone else already asked for this song. Share their
+                # download instead of starting another one.
+                logger.debug("Song with id %s is already downloading" % song_id)
+                download = self.downloads[song_id]
+                if not prefetch:
+                    # We need it now. Don't throttle or cancel it.
+                    download.claim()
+                return download
+
+            if os.path.exists(song_file):
+                return None
+
             if not os.path.exists(MUSIC_CACHE_DIR):
                 # Make sure the cache dir is present.
                 os.makedirs(MUSIC_CACHE_DIR)
-            if not song_id in self.download_queue:
-                # Check if the song is not already downloading
-                logger.debug("Downloading song with id: %s" % song_id)
-                self.download_queue.append(song_id)
-                try:
-                    stream = self._get_stream(song_id)
-                    f = open(song_file, "wb")
-                    f.write(stream.read())
-                    f.close()
-                    logger.debug("Finished downloading song with id: %s" % song_id)
-                except Exception as e:
-                    logger.error(
-                        "Could not download song with id: %s - Error was: %s" % (
-                            song_id, e
-                        )
-                    )
-                self.download_queue = [
-                    x for x in self.download_queue if x != song_id
-                ]
-            else:
-                logger.info(
-                    "Song with id %s is already in download queue. \
-                    Doing nothing." % song_id
+
+            download = Download(
+                song_id,
+                song_file,
+                prefetch=prefetch,
+                limiter=self.prefetch_limiter,
+                size=song.get("size")
+            )
+            self.downloads[song_id] = download
+
+        try:
+            self.download_pool.submit(self._download, download, song)
+        except RuntimeError:
+            # Shutting down.
+            with self.downloads_lock:
+                del self.downloads[song_id]
+            raise DownloadCancelled(song_id)
+        return download
+
+    def _download(self, download, song):
+        logger.debug("Downloading song with id: %s" % download.song_id)
+        error = None
+        try:
+            offset = download.resume_offset()
+            if offset:
+                logger.debug("Resuming download of song %s at byte %d" % (
+                    download.song_id, offset
+                ))
+            download.run(self._get_stream(download.song_id, offset), offset)
+        except DownloadCancelled as e:
+            logger.debug("Cancelled download of song: %s" % download.song_id)
+            metrics.inc("sonar_downloads_total", result="cancelled")
+            error = e
+        except Exception as e:
+            logger.error(
+                "Could not download song with id: %s - Error was: %s" % (
+                    download.song_id, e
                 )
-                # TODO: Handle this. Should we wait here for a little bit
-                # and see if it finishes downloading?
-                # At this point, if it clashes, it gets stuck in stopped state.
+            )
+            metrics.inc("sonar_downloads_total", result="error")
+            error = e
+        else:
+            logger.debug(
+                "Finished downloading song with id: %s" % download.song_id
+            )
+            metrics.inc("sonar_downloads_total", result="ok")
+            self.cache.add(download.song_id, download.received)
+            try:
+                self.tags.add(song, download.path)
+            except Exception as e:
+                logger.warning("Could not index tags of song %s: %s" % (
+                    download.song_id, e
+                ))
+            self.cache.enforce_limit()
+
+        with self.downloads_lock:
+            del self.downloads[download.song_id]
+            download.finish(error)
+
+    def download_progress(self, song_id):
+        download = self.downloads.get(str(song_id))
+        if download:
+            return download.progress()
+
+    def _stream_song(self, download):
+        """
+        Hands a song that is still downloading to MPlayer through a fifo.
+        MPlayer blocks on the fifo instead of hitting the end of a growing
+        file. Seeking is not possible until the song is played from the
+        cache.
+        """
+        fifo_dir = os.path.join(RUN_DIR, "stream")
+        os.makedirs(fifo_dir, exist_ok=True)
+        fifo = os.path.join(fifo_dir, "%s.mp3" % download.song_id)
+        try:
+            os.remove(fifo)
+        except FileNotFoundError:
+            pass
+        os.mkfifo(fifo)
 
-        return song_file
+        self.feed_pool.submit(self._feed, download, fifo)
+        return fifo
 
-    def play_song(self, song_id):
-        song_file = self._get_song(song_id)
+    def _feed(self, download, fifo):
+        fd = open_fifo_writer(fifo, timeout=10)
+        os.remove(fifo)
+        if fd is None:
+            logger.warning(
+                "MPlayer never opened the stream of song: %s" % download.song_id
+            )
+            return
+
+        try:
+            download.feed(fd)
+        except BrokenPipeError:
+            # MPlayer stopped reading, e.g. because another song was loaded.
+            logger.debug("Stopped streaming song: %s" % download.song_id)
+
+    def play_song(self, song):
+        """
+        Plays song if it is preloaded or cached. Otherwise starts downloading
+        it and returns the Download, to be handed to load_song() once
+        buffer_size() bytes of it are in. Never waits for the media server.
+        """
+        start = time.perf_counter()
+        self.loading = None
+        with self.switch_lock:
+            if self.preloaded == str(song["id"]):
+                # Skipping to the next song. It's ready to go.
+                self._release()
+                self.mplayer.stop()
+                self._switch()
+                self._played(start, "preloaded")
+                return None
+
+        song_file = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % song["id"])
+        download = None
+        if not os.path.exists(song_file):
+            download = self._start_download(song)
+        # After claiming the new download, in case it is the same one.
+        self._release()
+        self.download = download
+        if download is None:
+            logger.info("The song with id %s was found in the cache" % song["id"])
+            self._load(song, song_file, "cache", start)
+            return None
+
+        # Don't keep playing the last song while this one comes in.
+        self.mplayer.stop()
+        self.playing = None
+        self.loading = (song, download, start)
+        return download
+
+    def _release(self):
+        """
+        Lets go of the download of the last song played, so that it is
+        cancelled unless someone else needs it.
+        """
+        if self.download is not None:
+            self.download.release()
+            self.download = None
+
+    def buffer_size(self):
+        """
+        Bytes of a song that have to be on disk before it can be played, or
+        None for all of it.
+        """
+        stream_buffer = self.config.getint("sonar", "stream_buffer", fallback=0)
+        return stream_buffer if stream_buffer > 0 else None
+
+    def load_song(self, download):
+        """
+        Plays the song play_song() returned download for. Returns False if
+        another song was asked for in the meantime.
+        """
+        if self.loading is None or self.loading[1] is not download:
+            return False
+
+        song, download, start = self.loading
+        self.loading = None
+        if download.error and not os.path.exists(download.path):
+            logger.warning("Could not play song with id: %s" % song["id"])
+            return True
+
+        if download.done:
+            self._load(song, download.path, "download", start)
+        else:
+            # Start playing as soon as stream_buffer bytes are on disk
+            # instead of waiting for the whole song.
+            self._load(song, self._stream_song(download), "stream", start)
+        return True
+
+    def _load(self, song, song_file, source, start):
         self.mplayer.stop()
         self.mplayer.loadfile(song_file)
+        self.playing = str(song["id"])
 
         # Hacky, but needed to work. Check if Linux or Darwin, if so
         # also play the file after loading it. On OS X, pressing play
@@ -668,6 +1709,23 @@ class PlayerThread(threading.Thread):
         if "linux" or "darwin" in platform:
             self.mplayer.pause()
 
+        self._played(start, source)
+
+    def _played(self, start, source):
+        """
+        Records how long it took from being asked to play a song to handing
+        it to MPlayer, and whether the music cache had it.
+        """
+        metrics.observe(
+            "sonar_time_to_first_audio_seconds",
+            time.perf_counter() - start,
+            source=source
+        )
+        metrics.inc(
+            "sonar_music_cache_requests_total",
+            result="miss" if source in ("stream", "download") else "hit"
+        )
+
     def play(self):
         if self.is_paused():
             self.mplayer.pause()
@@ -676,6 +1734,8 @@ class PlayerThread(threading.Thread):
         self.mplayer.pause()
 
     def stop(self):
+        self.loading = None
+        self._release()
         self.mplayer.stop()
 
     def seek(self, timedelta):
@@ -692,6 +1752,14 @@ class PlayerThread(threading.Thread):
 
             self.mplayer.time_pos = new_time_pos
 
+    def refresh(self):
+        """
+        Asks MPlayer for its state and progress. Every property is a round
+        trip to MPlayer, so this is only done by the server's worker.
+        """
+        self.state = self.player_state()
+        self.last_progress = self.progress() if self.state != "Stopped" else None
+
     def player_state(self):
         if self.is_playing():
             return "Playing"
@@ -728,6 +1796,21 @@ class PlayerThread(threading.Thread):
 
     def quit(self):
         self.mplayer.quit()
+        if self.standby:
+            self.standby.quit()
+
+        # Downloads write to the cache, which is closed next.
+        with self.downloads_lock:
+            downloads = list(self.downloads.values())
+        for download in downloads:
+            download.abort()
+        for download in downloads:
+            if not download.wait(timeout=5):
+                logger.warning(
+                    "Download of song %s did not stop." % download.song_id
+                )
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
+        self.feed_pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     args = docopt(__doc__, version=__version__)
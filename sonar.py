@@ -5,6 +5,7 @@ Sonar Client
 
 Usage:
     sonar.py search [artist | album | song] (SEARCH_STRING...) [options]
+    sonar.py index [options]
     sonar.py playlists [options]
     sonar.py cached [options]
     sonar.py random [album | song] [options]
@@ -18,63 +19,122 @@ Usage:
     sonar.py (queue | q) [
         repeat [on | off] |
         shuffle |
+        unshuffle |
         sort |
-        (set | prepend | add | remove) [INDEX...]
+        (set | prepend | add | insert | remove | move) [INDEX...]
     ] [options]
+    sonar.py sync [status | cancel | clear | INDEX...] [options]
     sonar.py (interactive | i) [options]
+    sonar.py watch [options]
+    sonar.py metrics [options]
     sonar.py [status] [options]
 
 Options:
     -h --help                   Shows this screen
     -n LIMIT, --limit LIMIT     Limit results [default: 10]
+    --page PAGE                 Page of LIMIT cached songs to list, instead
+                                of all of them
+    --sort FIELD                Sort cached songs by title, artist or album
+                                [default: artist]
+    --seed SEED                 Seed for shuffling the queue, to get the same
+                                order again
     -s --short                  One line output
     -sb --statusbar             JSON output that can be used by statusbars
+    --interval INTERVAL         Seconds between progress updates when
+                                watching [default: 1]
     -l --loglevel LOGLEVEL      Set the loglevel [default: info]
                                 (critical | error | warning | info | debug)
     --version                   Show version
 
+`queue insert POSITION INDEX...` inserts results before a position in the
+queue, and `queue move FROM TO` moves the song at one position to another.
+
+`sync` downloads the given results into the music cache for listening
+offline, and keeps them there until `sync clear`.
+
+Commands can be chained with `;` (e.g. `sonar.py queue set 0 \\; play`). Queue
+and player commands in a chain are applied by the server as one batch.
+
 """
 
 __author__ = "Niclas Helbro <niclas.helbro@gmail.com>"
 __version__ = "Sonar Client 0.1.3"
 
-from docopt import docopt, DocoptExit
-
+# Only what every command needs is imported up front. The client is run
+# from hotkeys and statusbars, where interpreter startup is most of the
+# time spent, so the rest is imported where it is used.
 import os
 import sys
-import readline
 import socket
-import subprocess
 import json
-import datetime
+import struct
+import time
+import contextlib
 import logging
 import logging.config
-import glob
-from html.parser import HTMLParser
 
 from libsonar import Subsonic
 from libsonar import ensure_paths, read_config
+from libsonar import protocol
+from libsonar.results import read_results, write_results
+
+from variables import CACHE_DIR, MUSIC_CACHE_DIR, METADATA_CACHE_FILE
+from variables import SEARCH_INDEX_FILE, TAG_INDEX_FILE
+from variables import LOG_CONFIG, SOCKET_FILE
 
-from variables import CACHE_DIR, MUSIC_CACHE_DIR
-from variables import LOG_CONFIG
+# Hosts that mean the server runs on this machine.
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1", "")
 
 
 class SonarClient(object):
-    def __init__(self, subsonic):
+    # Operations whose response is needed by the caller.
+    read_operations = ("status", "show_queue", "sync", "metrics")
+
+    # Song fields needed to print the queue.
+    queue_fields = ("id", "title", "artist")
+
+    def __init__(self, subsonic=None):
         self.config = read_config()
 
         self.socket = None
-        self.subsonic = subsonic.connection
+        self.protocol_version = None
+        self.batched = None
+        # Connecting to the media server costs a round-trip (or a timeout
+        # when it is unreachable), and most commands only talk to the sonar
+        # server. Connect when the media server is actually needed.
+        self._subsonic = subsonic
+        self._metadata = None
         self.cached_results = os.path.join(CACHE_DIR, "results.cache")
+        self.cached_queue = os.path.join(CACHE_DIR, "queue.cache")
 
         self.is_interactive = False
 
+    @property
+    def subsonic(self):
+        if self._metadata is None:
+            from libsonar.metadata import MetadataCache, MetadataConnection
+            self._metadata = MetadataConnection(
+                MetadataCache(
+                    METADATA_CACHE_FILE,
+                    self.config.getint("sonar", "metadata_ttl", fallback=86400)
+                ),
+                self._connect_media_server
+            )
+        return self._metadata
+
+    def _connect_media_server(self):
+        if self._subsonic is None:
+            self._subsonic = Subsonic()
+        return self._subsonic.connection
+
     def _delegate_command(self, args):
         """
         Main arg handler
         """
         if args.get("search", False):
             client.search(args)
+        elif args.get("index", False):
+            client.index(args)
         elif args.get("cached", False):
             client.list_cached_songs(args)
         elif args.get("playlists", False):
@@ -103,6 +163,8 @@ class SonarClient(object):
         elif args.get("queue") or args.get("q"):
             if args.get("shuffle"):
                 client.shuffle(args)
+            elif args.get("unshuffle"):
+                client.unshuffle(args)
             elif args.get("repeat"):
                 client.repeat(args)
             elif args.get("sort"):
@@ -113,6 +175,10 @@ class SonarClient(object):
                 client.prepend_queue(args)
             elif args["add"]:
                 client.append_queue(args)
+            elif args.get("insert"):
+                client.insert_into_queue(args)
+            elif args.get("move"):
+                client.move_in_queue(args)
             elif args.get("remove"):
                 args["INDEX"] = args.get("INDEX", [])
                 if len(args["INDEX"]) == 0:
@@ -122,6 +188,12 @@ class SonarClient(object):
             else:
                 # Default to show queue
                 client.show_queue()
+        elif args.get("sync"):
+            client.sync(args)
+        elif args.get("watch"):
+            client.watch(args)
+        elif args.get("metrics"):
+            client.metrics(args)
         elif args.get("interactive") or args.get("i"):
             # Interavtive shell
             if self.is_interactive:
@@ -137,27 +209,147 @@ class SonarClient(object):
 
         return True
 
-    def _socket_send(self, data):
+    def _connect(self):
+        self.protocol_version = None
+        if self._connect_unix():
+            return
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.socket.connect((
             self.config['sonar']['host'],
             int(self.config['sonar']['port'])
         ))
 
-        request = json.dumps(data)
-        self.socket.sendall(request.encode("utf-8"))
-        logger.debug("Sent request: %s" % data)
+    def _connect_unix(self):
+        """
+        Connects through the server's Unix socket if the server runs on this
+        machine and has one. Returns False to fall back to TCP.
+        """
+        if not self.config.getboolean("sonar", "unix_socket", fallback=True):
+            return False
+        if self.config['sonar']['host'] not in LOCAL_HOSTS:
+            return False
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SOCKET_FILE)
+        except OSError:
+            # No server, or an old one that only listens on TCP.
+            sock.close()
+            return False
+
+        self.socket = sock
+        return True
 
-        response = self.socket.recv(102400)
-        response = response.decode("utf-8")
+    def _disconnect(self):
+        if self.socket:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+
+    def _delegate_commands(self, args_list):
+        """
+        Runs several commands. Anything that only changes the server state
+        is sent as one atomic batch, in a single round-trip.
+        """
+        if len(args_list) == 1:
+            return self._delegate_command(args_list[0])
+
+        with self.batch():
+            for args in args_list:
+                self._delegate_command(args)
+
+        return True
+
+    def _socket_send(self, data):
+        if self.batched is not None:
+            if data["operation"] not in self.read_operations:
+                # Collected and sent as one batch when the batch ends.
+                self.batched.append(data)
+                return {"code": "OK"}
+
+            # The caller needs an answer. Send what we have so far in
+            # front of it.
+            requests = self._flush_batch() + [data]
+            return self._socket_send_many(requests)[-1]
+
+        return self._socket_send_many([data])[0]
+
+    def _socket_send_many(self, requests):
+        """
+        Pipelines the requests over the (persistent) server connection and
+        returns the responses in the same order.
+        """
+        for attempt in range(2):
+            reused = self.socket is not None
+            try:
+                if not reused:
+                    self._connect()
+
+                buffers = []
+                if self.protocol_version is None:
+                    # The handshake goes out together with the first
+                    # request, so framing does not cost a round-trip.
+                    buffers.append(protocol.encode_handshake())
+                for request in requests:
+                    buffers.extend(protocol.encode_frame(request))
+                protocol.sendmsg_all(self.socket, buffers)
+                logger.debug("Sent requests: %s" % json.dumps(requests))
+
+                if self.protocol_version is None:
+                    self.protocol_version = protocol.recv_handshake(
+                        self.socket
+                    )
+                responses = [
+                    protocol.recv_message(self.socket) for _ in requests
+                ]
+                break
+            except (ConnectionError, protocol.ProtocolError):
+                self._disconnect()
+                if not reused or attempt > 0:
+                    raise
+                # The server probably dropped the idle connection (or was
+                # restarted). Reconnect and try again.
+                logger.debug("Server connection lost. Reconnecting.")
+
+        for response_data in responses:
+            logger.debug("Got response: %s" % response_data)
+            if "message" in response_data:
+                print("\n%s\n" % response_data["message"])
+
+        return responses
+
+    def _flush_batch(self):
+        requests = []
+        if self.batched:
+            requests.append({
+                "operation": "batch",
+                "operations": self.batched
+            })
+        self.batched = [] if self.batched is not None else None
+        return requests
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collects the requests made inside the block and has the server apply
+        them atomically, in one round-trip.
+        """
+        self.batched = []
+        try:
+            yield
+            requests = self._flush_batch()
+        finally:
+            self.batched = None
 
-        response_data = json.loads(response)
-        logger.debug("Got response: %s" % response)
-        if "message" in response_data:
-            print("\n%s\n" % response_data["message"])
+        if requests:
+            self._socket_send_many(requests)
 
-        self.socket.close()
-        return response_data
+    def close(self):
+        self._disconnect()
 
     def _format_results(self, results):
         for kind in ["artist", "album", "song", "playlists"]:
@@ -166,25 +358,33 @@ class SonarClient(object):
         return results
 
     def _cache_results(self, results):
-        f = open(self.cached_results, "wt+")
-        f.write(json.dumps(results))
-        f.close()
+        write_results(self.cached_results, results)
 
     def _cached_results(self):
+        """
+        Returns a lazy view of the cached results, which only decodes the
+        entries that are actually used.
+        """
         try:
-            f = open(self.cached_results, "rt")
-            results = json.loads(f.read())
-            f.close()
-        except:
+            results = read_results(self.cached_results)
+        except (OSError, ValueError, struct.error):
             results = []
 
-        logger.debug("Used cached results: %s" % json.dumps(results))
+        logger.debug("Used cached results: %s" % {
+            kind: len(entries) for kind, entries in dict(results).items()
+        })
 
         return results
 
     def _cached_songs(self):
-        cached_paths = glob.glob(os.path.join(MUSIC_CACHE_DIR, "*.mp3"))
-        return [os.path.basename(x).replace(".mp3", "") for x in cached_paths]
+        """
+        Returns the set of ids of the songs in the music cache.
+        """
+        return {
+            name[:-len(".mp3")]
+            for name in os.listdir(MUSIC_CACHE_DIR)
+            if name.endswith(".mp3")
+        }
 
     def _build_server_data(self, idxs):
         res_list = self._cached_results()
@@ -279,9 +479,9 @@ class SonarClient(object):
         return data
 
     def _print(self, data, end="\n"):
-        if type(data) == str:
-            parser = HTMLParser()
-            data = parser.unescape(data)
+        if type(data) == str and "&" in data:
+            import html
+            data = html.unescape(data)
         print(data, end=end)
 
     def _print_results(self, results=None):
@@ -298,7 +498,8 @@ class SonarClient(object):
             self._print_queue(
                 results['queue'],
                 results.get("current_song", 0),
-                results.get("player_state", None)
+                results.get("player_state", None),
+                results.get("cached", None)
             )
         elif "playlists" in results and len(results["playlists"]) > 0:
             self._print_playlists(results['playlists'])
@@ -364,13 +565,18 @@ class SonarClient(object):
             idx += 1
         print()
 
-    def _print_queue(self, songs, current_song=None, player_state=None):
+    def _print_queue(self, songs, current_song=None, player_state=None,
+                     cached=None):
         if type(songs) == dict:
             songs = [songs]
 
         print(self._colorize("\n* Queue *\n", "white"))
 
-        cached_songs = self._cached_songs()
+        if cached is None:
+            # Older servers don't say which songs are cached.
+            cached_songs = self._cached_songs()
+            cached = [str(song['id']) in cached_songs for song in songs]
+
         idx = 0
         for song in songs:
             song_string = "%s: %s (%s) [ID: %s]" % (
@@ -391,7 +597,7 @@ class SonarClient(object):
 
                 song_string = self._colorize(song_string, color)
 
-            if str(song['id']) in cached_songs:
+            if cached[idx]:
                 song_string += " %s" % self._colorize("*", "green")
 
             self._print(song_string)
@@ -413,8 +619,14 @@ class SonarClient(object):
 
     def _format_time(self, secs):
         if isinstance(secs, int):
+            import datetime
             return datetime.timedelta(seconds=secs)
 
+    def _format_download(self, download):
+        if download and download.get("percent") is not None:
+            return "Downloading (%s%%)" % download["percent"]
+        return "Downloading"
+
     def _colorize(self, string="", color=None):
         colors = {
             "red": "\033[1;91m",
@@ -458,6 +670,22 @@ class SonarClient(object):
 
     def get_search(self, args):
         query = " ".join(args["SEARCH_STRING"])
+        if "artist" in args and args["artist"]:
+            kind = "artist"
+        elif "album" in args and args["album"]:
+            kind = "album"
+        else:
+            kind = "song"
+
+        ret = self._search_index(kind, query, args['--limit'])
+        if ret is None:
+            ret = self._search_server(kind, query, args['--limit'])
+
+        logger.debug("Search retults: %s" % json.dumps(ret))
+
+        return self._format_results(ret)
+
+    def _search_server(self, kind, query, limit):
         kwargs = {
             "artistCount": 0,
             "artistOffset": 0,
@@ -466,28 +694,54 @@ class SonarClient(object):
             "songCount": 0,
             "songOffset": 0
         }
-        if "artist" in args and args["artist"]:
-            kwargs["artistCount"] = args['--limit']
-            res = self.subsonic.search3(query, **kwargs)
-            ret = {"artist": []}
-            if "artist" in res["searchResult3"]:
-                ret["artist"] = res["searchResult3"]["artist"]
-        elif "album" in args and args["album"]:
-            kwargs["albumCount"] = args['--limit']
-            res = self.subsonic.search3(query, **kwargs)
-            ret = {"album": []}
-            if "album" in res["searchResult3"]:
-                ret["album"] = res["searchResult3"]["album"]
-        elif "song" in args and args["song"]:
-            kwargs["songCount"] = args['--limit']
-            res = self.subsonic.search3(query, **kwargs)
-            ret = {"song": []}
-            if "song" in res["searchResult3"]:
-                ret["song"] = res["searchResult3"]["song"]
+        kwargs["%sCount" % kind] = limit
+        res = self.subsonic.search3(query, **kwargs)
+        ret = {kind: []}
+        if kind in res["searchResult3"]:
+            ret[kind] = res["searchResult3"][kind]
+        return ret
+
+    def _search_index(self, kind, query, limit):
+        """
+        Searches the local index, if it is enabled and fresh. Returns None
+        if the media server has to be asked instead.
+        """
+        if not self.config.getboolean("sonar", "search_index", fallback=False):
+            return None
+        if not os.path.exists(SEARCH_INDEX_FILE):
+            return None
 
-        logger.debug("Search retults: %s" % json.dumps(ret))
+        from libsonar.search import SearchIndex
+        index = SearchIndex(SEARCH_INDEX_FILE)
+        try:
+            age = index.age()
+            max_age = self.config.getint(
+                "sonar", "search_index_max_age", fallback=604800
+            )
+            if age is None or age > max_age:
+                logger.info("Search index is stale. Asking the server.")
+                return None
+            return {kind: index.search(kind, query, limit)}
+        finally:
+            index.close()
+
+    def index(self, args):
+        """
+        Builds or refreshes the local search index.
+        """
+        from libsonar.search import SearchIndex
+        index = SearchIndex(SEARCH_INDEX_FILE)
+        try:
+            print("\nIndexing the library...")
+            # Straight to the media server. The index must not be built
+            # from cached album lists.
+            updated, removed = index.refresh(self._connect_media_server())
+        finally:
+            index.close()
 
-        return self._format_results(ret)
+        print("%d albums indexed, %d removed.\n" % (updated, removed))
+        if not self.config.getboolean("sonar", "search_index", fallback=False):
+            print("Set `search_index = True` in sonar.conf to search it.\n")
 
     def drill(self, args):
         drill_index = args.get("INDEX")
@@ -539,32 +793,34 @@ class SonarClient(object):
         logger.debug("Listing cached songs: %s" % json.dumps(res))
 
     def get_cached_songs(self, args):
-        tag_data_map = {
-            "title": (3, 33),
-            "artist": (33, 63),
-            "album": (63, 93),
-        }
-        cached_songs = []
-        for song_path in glob.glob(os.path.join(MUSIC_CACHE_DIR, "*.mp3")):
-            song_id = os.path.basename(song_path).replace(".mp3", "")
-            try:
-                with open(song_path, "rb", 0) as song_file:
-                    try:
-                        song_file.seek(-128, 2)
-                        tag_data = song_file.read(128)
-                    finally:
-                        song_file.close()
-
-                    if tag_data[:3] == b"TAG":
-                        song_dict = {"id": song_id}
-                        for tag, (start, end) in tag_data_map.items():
-                            song_dict[tag] = tag_data[start:end].decode(
-                                "utf-8", "replace").replace("\x00", "").strip()
-                        cached_songs.append(song_dict)
-            except IOError:
-                # Something went wrong getting ID3 tag data,
-                # just skip this song.
-                pass
+        from libsonar.tags import TagIndex, ORDER_BY
+
+        sort = args.get("--sort") or "artist"
+        if sort not in ORDER_BY:
+            print("\nCan't sort by %s. Use one of: %s\n" % (
+                sort, ", ".join(sorted(ORDER_BY))
+            ))
+            return self._format_results({"song": []})
+
+        # All of them, unless a page is asked for.
+        limit = offset = None
+        if args.get("--page") is not None:
+            limit = int(args.get("--limit") or 10)
+            offset = int(args["--page"]) * limit
+
+        tags = TagIndex(TAG_INDEX_FILE)
+        try:
+            # Only songs the server didn't index (e.g. cached by an older
+            # version) have their files opened, and only once.
+            tags.sync(MUSIC_CACHE_DIR, self._cached_songs())
+            cached_songs = tags.songs(
+                MUSIC_CACHE_DIR,
+                sort=sort,
+                offset=offset or 0,
+                limit=limit
+            )
+        finally:
+            tags.close()
 
         ret = {"song": cached_songs}
         return self._format_results(ret)
@@ -579,6 +835,38 @@ class SonarClient(object):
         ret = {"playlists": res.get("playlists", {}).get("playlist", [])}
         return self._format_results(ret)
 
+    def _statusbar_data(self, ct):
+        if not ct:
+            return {}
+
+        data = {
+            "song": {
+                "artist": ct["song"]["artist"],
+                "album": ct["song"]["album"],
+                "title": ct["song"]["title"],
+            },
+            "player": {
+                "queue_position": ct["queue_position"],
+                "queue_lenght": ct["queue_length"],
+                "state": ct["player_state"],
+                "repeat": ct["repeat"],
+                "shuffle": ct["shuffle"],
+                "downloading": ct["downloading"]
+            }
+        }
+        if "progress" in ct and ct["progress"]:
+            data["progress"] = {
+                "time": str(self._format_time(ct["progress"]["time"])),
+                "length": str(self._format_time(ct["progress"]["length"])),
+                "percent": ct["progress"]["percent"]
+            }
+        if "queue" in ct and ct["queue"]:
+            data["queue"] = {
+                "index": ct["queue"]["index"],
+                "length": ct["queue"]["length"]
+            }
+        return data
+
     def status(self, args):
         request = {
             "operation": "status"
@@ -600,7 +888,7 @@ class SonarClient(object):
                     # If Downloading, we do not want to show any other player
                     # info.
                     progress_list.append(self._colorize(
-                        "Downloading",
+                        self._format_download(ct.get("download")),
                         "magenta"
                     ))
                 else:
@@ -636,33 +924,7 @@ class SonarClient(object):
 
                 self._print(currently_playing_string)
         elif "--statusbar" in args and args["--statusbar"]:
-            ct = result["current_song"]
-            data = {
-                "song": {
-                    "artist": ct["song"]["artist"],
-                    "album": ct["song"]["album"],
-                    "title": ct["song"]["title"],
-                },
-                "player": {
-                    "queue_position": ct["queue_position"],
-                    "queue_lenght": ct["queue_length"],
-                    "state": ct["player_state"],
-                    "repeat": ct["repeat"],
-                    "shuffle": ct["shuffle"],
-                    "downloading": ct["downloading"]
-                }
-            }
-            if "progress" in ct and ct["progress"]:
-                data["progress"] = {
-                    "time": str(self._format_time(ct["progress"]["time"])),
-                    "length": str(self._format_time(ct["progress"]["length"])),
-                    "percent": ct["progress"]["percent"]
-                }
-            if "queue" in ct and ct["queue"]:
-                data["queue"] = {
-                    "index": ct["queue"]["index"],
-                    "length": ct["queue"]["length"]
-                }
+            data = self._statusbar_data(result["current_song"])
             self._print(json.dumps(data), end="")
         else:
             if "current_song" in result and result["current_song"]:
@@ -681,7 +943,7 @@ class SonarClient(object):
                     # If Downloading, we do not want to show any other player
                     # info.
                     progress_list.append(self._colorize(
-                        "Downloading",
+                        self._format_download(ct.get("download")),
                         "magenta"
                     ))
                 else:
@@ -768,6 +1030,15 @@ class SonarClient(object):
         request = {
             "operation": "shuffle"
         }
+        if args.get("--seed") is not None:
+            request["seed"] = int(args["--seed"])
+
+        self._socket_send(request)
+
+    def unshuffle(self, args):
+        request = {
+            "operation": "unshuffle_queue"
+        }
 
         self._socket_send(request)
 
@@ -800,27 +1071,91 @@ class SonarClient(object):
         self._socket_send(request)
 
     def show_queue(self):
+        cached_queue = self._cached_queue()
         request = {
             "operation": "show_queue",
+            "fields": self.queue_fields
         }
+        if cached_queue:
+            # Only what changed since is sent back.
+            request.update({
+                "queue_id": cached_queue["queue_id"],
+                "queue_version": cached_queue["queue_version"],
+                "cache_version": cached_queue["cache_version"]
+            })
 
         result = self._socket_send(request)
+        queue = self._update_queue(cached_queue, result)
 
-        if "queue" in result and \
-                isinstance(result["queue"], list) and \
-                len(result["queue"]) > 0:
-            songs = []
-            for item in result["queue"]:
-                songs.append(item)
+        if queue["songs"]:
             self._print_results({
-                "queue": songs,
+                "queue": queue["songs"],
                 "current_song": result.get("current_song", 0),
-                "player_state": result.get("player_state", None)
+                "player_state": result.get("player_state", None),
+                "cached": queue["cached"]
             })
 
         else:
             print("\nQueue is empty.\n")
 
+        for error in result.get("queue_errors", []):
+            print("Could not queue %s %s: %s" % (
+                error["kind"],
+                error["id"],
+                error["message"]
+            ))
+
+    def _cached_queue(self):
+        try:
+            with open(self.cached_queue, "rt") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _update_queue(self, cached_queue, result):
+        """
+        Brings the cached copy of the queue up to date with a show_queue
+        response and returns it.
+        """
+        if "queue" in result or not cached_queue:
+            queue = {
+                "entries": result.get("entries"),
+                "songs": result.get("queue", []),
+                "cached": result.get("cached")
+            }
+        else:
+            queue = cached_queue
+            entries = list(zip(queue["entries"], queue["songs"]))
+            for change in result.get("changes", []):
+                if change[0] == "insert":
+                    _, position, inserted = change
+                    entries[position:position] = [tuple(e) for e in inserted]
+                elif change[0] == "remove":
+                    for position in change[1]:
+                        del entries[position]
+                elif change[0] == "move":
+                    _, source, destination = change
+                    entries.insert(destination, entries.pop(source))
+            queue["entries"] = [entry_id for entry_id, _ in entries]
+            queue["songs"] = [song for _, song in entries]
+            if "cached" in result:
+                queue["cached"] = result["cached"]
+
+        if queue["entries"] is None or "queue_version" not in result:
+            # Older server. Nothing to keep.
+            return queue
+
+        queue.update({
+            "queue_id": result["queue_id"],
+            "queue_version": result["queue_version"],
+            "cache_version": result["cache_version"]
+        })
+        tmp_file = "%s.%d.tmp" % (self.cached_queue, os.getpid())
+        with open(tmp_file, "wt") as f:
+            json.dump(queue, f)
+        os.replace(tmp_file, self.cached_queue)
+        return queue
+
     def set_queue(self, args):
         request = {
             "operation": "set_queue",
@@ -845,6 +1180,32 @@ class SonarClient(object):
 
         self._socket_send(request)
 
+    def insert_into_queue(self, args):
+        if len(args["INDEX"]) < 2:
+            print("\nGive a queue position and the results to insert.\n")
+            return
+
+        request = {
+            "operation": "insert_into_queue",
+            "position": args["INDEX"][0],
+            "data": self._build_server_data(args["INDEX"][1:])
+        }
+
+        self._socket_send(request)
+
+    def move_in_queue(self, args):
+        if len(args["INDEX"]) != 2:
+            print("\nGive the queue position to move from and to.\n")
+            return
+
+        request = {
+            "operation": "move_in_queue",
+            "source": args["INDEX"][0],
+            "destination": args["INDEX"][1]
+        }
+
+        self._socket_send(request)
+
     def remove_from_queue(self, args):
         request = {
             "operation": "remove_from_queue",
@@ -853,7 +1214,135 @@ class SonarClient(object):
 
         self._socket_send(request)
 
+    def sync(self, args):
+        request = {"operation": "sync"}
+        if args.get("cancel"):
+            request["action"] = "cancel"
+        elif args.get("clear"):
+            request["action"] = "clear"
+        elif not args.get("status"):
+            request["action"] = "start"
+            request["data"] = self._build_server_data(args.get("INDEX", []))
+
+        response = self._socket_send(request)
+        if response.get("code") == "OK":
+            self._print_sync(response["sync"])
+
+    def _print_sync(self, sync):
+        print(self._colorize("\n* Sync *\n", "white"))
+        print("%s: %d of %d songs done, %d failed (%d Mb received)" % (
+            sync["state"].capitalize(),
+            sync["done"],
+            sync["total"],
+            len(sync["failed"]),
+            sync["received"] >> 20
+        ))
+        for song_id, download in sync["downloading"].items():
+            print("  %s: %s" % (song_id, self._format_download(download)))
+        for item, message in sync["failed"].items():
+            self._print(self._colorize("  %s: %s" % (item, message), "red"))
+        print("Pinned: %d songs, %d of %d Mb" % (
+            sync["pinned"],
+            sync["pinned_size"] >> 20,
+            sync["limit"] >> 20
+        ))
+        if sync["state"] == "full":
+            print("The cache is full. Raise cache_limit to sync more.")
+        print()
+
+    def metrics(self, args):
+        response = self._socket_send({"operation": "metrics"})
+        if response.get("code") != "OK":
+            return
+
+        metrics = response["metrics"]
+        if args.get("--statusbar"):
+            print(json.dumps(metrics))
+            return
+
+        counters = {}
+        for counter in metrics["counters"]:
+            key = (counter["name"],) + tuple(sorted(counter["labels"].items()))
+            counters[key] = counter["value"]
+
+        def count(name, **labels):
+            return sum(
+                value for key, value in counters.items()
+                if key[0] == name and set(labels.items()) <= set(key[1:])
+            )
+
+        def ms(seconds):
+            if seconds is None:
+                return "-"
+            return "%.1f ms" % (seconds * 1000)
+
+        print(self._colorize("\n* Metrics *\n", "white"))
+        print("%-36s %8s %10s %10s" % ("Latency", "count", "p50", "p99"))
+        for histogram in metrics["histograms"]:
+            labels = ", ".join(histogram["labels"].values())
+            name = histogram["name"][len("sonar_"):-len("_seconds")]
+            print("%-36s %8d %10s %10s" % (
+                "%s (%s)" % (name, labels) if labels else name,
+                histogram["count"],
+                ms(histogram["p50"]),
+                ms(histogram["p99"])
+            ))
+
+        print()
+        for kind in ("music", "metadata"):
+            name = "sonar_%s_cache_requests_total" % kind
+            hits, total = count(name, result="hit"), count(name)
+            print("%s cache: %d of %d hits (%s)" % (
+                kind.capitalize(),
+                hits,
+                total,
+                "%d%%" % (100 * hits // total) if total else "-"
+            ))
+        print("Evicted: %d songs" % count("sonar_music_cache_evictions_total"))
+
+        received = count("sonar_download_bytes_total")
+        seconds = count("sonar_download_seconds_total")
+        print("Downloaded: %d Mb, %s per download (%d ok, %d failed)" % (
+            received >> 20,
+            "%.1f Mb/s" % (received / seconds / (1 << 20)) if seconds else "-",
+            count("sonar_downloads_total", result="ok"),
+            count("sonar_downloads_total", result="error")
+        ))
+        print()
+
+    def watch(self, args):
+        """
+        Subscribes to the server and prints a line of JSON whenever the
+        player state changes, until interrupted.
+        """
+        request = {
+            "operation": "subscribe",
+            "interval": float(args.get("--interval") or 1)
+        }
+
+        try:
+            while True:
+                try:
+                    response = self._socket_send(request)
+                    if response.get("code") != "OK":
+                        return
+
+                    while True:
+                        event = protocol.recv_message(self.socket)
+                        if args.get("--statusbar"):
+                            event = self._statusbar_data(event["status"])
+                        print(json.dumps(event), flush=True)
+                except (ConnectionError, protocol.ProtocolError):
+                    # Server went away. Wait for it to come back.
+                    logger.debug("Lost the server. Resubscribing.")
+                    self._disconnect()
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            self.close()
+
     def interactive(self, args):
+        # Gives input() line editing and history.
+        import readline
 
         prompt = "sonar > "
 
@@ -871,11 +1360,14 @@ class SonarClient(object):
                 elif "quit" in commands or "exit" in commands:
                     logger.info("Quitting interactive client.")
                     print("\nbye...\n")
+                    self.close()
                     sys.exit(0)
                 else:
                     try:
-                        interactive_args = get_args(argv=commands, help=False, is_interactive=True)
-                        self._delegate_command(interactive_args)
+                        self._delegate_commands([
+                            get_args(argv=argv, help=False, is_interactive=True)
+                            for argv in split_commands(commands)
+                        ])
                     except Exception:
                         pass
 
@@ -883,14 +1375,74 @@ class SonarClient(object):
             # User wants out. Oblige.
             logger.info("Quitting interactive client. Got keyboard interrupt.")
             print("\n\nbye...\n")
+            self.close()
             sys.exit(0)
 
 
+def split_commands(argv):
+    """
+    Splits `queue set 0 ; ff 30 ; play` into separate commands.
+    """
+    if not any(";" in arg for arg in argv):
+        return [argv]
+
+    return [
+        command.split()
+        for command in " ".join(argv).split(";")
+        if command.strip()
+    ]
+
+
+# Hotkey and statusbar commands. Common enough that their args are built
+# directly instead of matching argv against the whole usage pattern.
+FAST_COMMANDS = ("status", "pause", "p", "next", "previous", "stop")
+FAST_OPTIONS = {
+    "-s": "--short",
+    "--short": "--short",
+    "-sb": "--statusbar",
+    "--statusbar": "--statusbar"
+}
+
+
+def get_fast_args(argv):
+    """
+    Returns the args of a plain hot command (e.g. `sonar.py next -s`)
+    without parsing the usage pattern, or None if argv needs the full parser.
+    """
+    commands = [arg for arg in argv if not arg.startswith("-")]
+    options = [arg for arg in argv if arg.startswith("-")]
+    if len(commands) > 1 or (commands and commands[0] not in FAST_COMMANDS):
+        return None
+    if any(option not in FAST_OPTIONS for option in options):
+        return None
+
+    # Same defaults as the usage pattern.
+    args = {
+        "--limit": "10",
+        "--page": None,
+        "--sort": "artist",
+        "--short": False,
+        "--statusbar": False,
+        "--interval": "1",
+        "--loglevel": "info",
+        "INDEX": [],
+        "TIMEDELTA": 10,
+        "song": True
+    }
+    for command in commands:
+        args[command] = True
+    for option in options:
+        args[FAST_OPTIONS[option]] = True
+    return args
+
+
 def get_args(argv=None, help=True, is_interactive=False):
     """
      Get args and fix defaults and fallbacks
     """
 
+    from docopt import docopt, DocoptExit
+
     try:
         args = docopt(__doc__, argv=argv, help=help, version=__version__)
     except DocoptExit as e:
@@ -940,7 +1492,11 @@ def get_args(argv=None, help=True, is_interactive=False):
 
 
 if __name__ == "__main__":
-    args = get_args()
+    args_list = [
+        get_fast_args(argv) or get_args(argv=argv)
+        for argv in split_commands(sys.argv[1:])
+    ]
+    args = args_list[0]
 
     ###
     ##  Setup logging
@@ -979,9 +1535,9 @@ if __name__ == "__main__":
     ###
     ##  Instatiate classes
     ###
-    subsonic = Subsonic()
-    client = SonarClient(subsonic)
+    client = SonarClient()
     logger.info("Initiated the client.")
 
-    logger.debug("Called with arguments: %s" % json.dumps(args))
-    client._delegate_command(args)
+    logger.debug("Called with arguments: %s" % json.dumps(args_list))
+    client._delegate_commands(args_list)
+    client.close()
@@ -0,0 +1,321 @@
+"""
+Test setup.
+
+The server needs MPlayer and a media server, neither of which is around
+when testing. The mplayer and py-sonic modules are replaced by the stand-ins
+below, which record what they are asked to do, and HOME points at a
+temporary directory that holds the config, the caches and the sockets.
+"""
+
+import io
+import os
+import sys
+import time
+import types
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOME = tempfile.mkdtemp(prefix="sonar-tests-")
+
+# variables.py builds its paths from HOME when it is imported.
+os.environ["HOME"] = HOME
+sys.path.insert(0, ROOT)
+
+
+class FakeMPlayer(object):
+    """
+    Stands in for mplayer.Player. Every command is recorded with the time
+    it was given, and stdout.emit() plays MPlayer printing a line.
+    """
+    def __init__(self, args=()):
+        self.stdout = Signal()
+        self.commands = []
+        self.filename = None
+        self.paused = False
+        self.time_pos = None
+        self.length = None
+        self.percent_pos = None
+        # When the player last went from paused to playing.
+        self.resumed = None
+
+    def _record(self, command, *args):
+        self.commands.append((time.perf_counter(), command) + args)
+
+    def loadfile(self, filename):
+        self._record("loadfile", filename)
+        # Loaded files stay paused until told to play.
+        self.filename = filename
+        self.paused = True
+        self.time_pos = 0
+        self.length = 100
+        self.percent_pos = 0
+
+    def pause(self):
+        self._record("pause")
+        self.paused = not self.paused
+        if not self.paused:
+            self.resumed = time.perf_counter()
+
+    def stop(self):
+        self._record("stop")
+        self.filename = None
+        self.paused = False
+        self.time_pos = None
+
+    def quit(self):
+        self._record("quit")
+
+
+class Signal(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+    def emit(self, data):
+        for callback in self.callbacks:
+            callback(data)
+
+
+class FakeConnection(object):
+    """
+    Stands in for a py-sonic Connection. Albums are whatever the tests put
+    in `albums`, streams are `size` bytes of silence. While `gate` is set
+    to an Event, album lookups and streams wait for it, like a slow media
+    server. Streams take `delay` seconds per chunk.
+    """
+    albums = {}
+    gate = None
+    delay = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getLicense(self):
+        return {"license": {"valid": True}}
+
+    def getIndexes(self, musicFolderId=None, ifModifiedSince=0):
+        return {"indexes": {"lastModified": 1}}
+
+    def _wait(self):
+        if self.gate is not None:
+            self.gate.wait(10)
+
+    def getAlbum(self, album_id):
+        self._wait()
+        return {"album": {"song": self.albums[album_id]}}
+
+    def getSong(self, song_id):
+        for songs in self.albums.values():
+            for song in songs:
+                if str(song["id"]) == str(song_id):
+                    return {"song": song}
+        raise Exception("No such song: %s" % song_id)
+
+    def stream(self, song_id):
+        self._wait()
+        size = self.getSong(song_id)["song"].get("size", 3000)
+        stream = SlowStream(b"\0" * size, self.delay)
+        stream.length = size
+        return stream
+
+
+class SlowStream(io.BytesIO):
+    def __init__(self, data, delay):
+        super(SlowStream, self).__init__(data)
+        self.delay = delay
+
+    def readinto(self, buf):
+        time.sleep(self.delay)
+        return super(SlowStream, self).readinto(buf)
+
+
+def _install_fakes():
+    mplayer = types.ModuleType("mplayer")
+    mplayer.Player = FakeMPlayer
+    sys.modules["mplayer"] = mplayer
+
+    connection = types.ModuleType("pysonic.libsonic.connection")
+    connection.Connection = FakeConnection
+    sys.modules["pysonic"] = types.ModuleType("pysonic")
+    sys.modules["pysonic.libsonic"] = types.ModuleType("pysonic.libsonic")
+    sys.modules["pysonic.libsonic.connection"] = connection
+
+    try:
+        import docopt
+    except ImportError:
+        # Only used when sonar-server.py is run as a script.
+        docopt = types.ModuleType("docopt")
+        docopt.docopt = None
+        sys.modules["docopt"] = docopt
+
+
+_install_fakes()
+
+
+def song(song_id, album="album", track=1, size=3000):
+    return {
+        "id": song_id,
+        "title": "Song %s" % song_id,
+        "artist": "Artist",
+        "album": album,
+        "artistId": "artist",
+        "albumId": album,
+        "discNumber": 1,
+        "track": track,
+        "size": size,
+        "duration": 100
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def write_config(media_server="http://localhost", **options):
+    from variables import CONFIG_DIR, CONFIG_FILE
+    sonar = {
+        "host": "localhost",
+        "port": str(_free_port()),
+        "prefetch": "False",
+        "cache_limit": "500",
+        "status_interval": "0.1",
+    }
+    sonar.update((k, str(v)) for k, v in options.items())
+
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    with open(CONFIG_FILE, "wt") as f:
+        f.write("[media-server]\n")
+        f.write("host: %s\nport: 4040\n" % media_server)
+        f.write("user: user\npassword: password\n\n[sonar]\n")
+        for name, value in sonar.items():
+            f.write("%s = %s\n" % (name, value))
+    return sonar
+
+
+@pytest.fixture
+def config():
+    return write_config
+
+
+@pytest.fixture(scope="session")
+def sonar_server():
+    """
+    The sonar-server.py module.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "sonar_server", os.path.join(ROOT, "sonar-server.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Set up by the script's main block.
+    module.logger = logging.getLogger("sonar-server")
+    return module
+
+
+@pytest.fixture(scope="session")
+def sonar_client():
+    """
+    The sonar.py module.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "sonar_client", os.path.join(ROOT, "sonar.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.logger = logging.getLogger("sonar-client")
+    return module
+
+
+@pytest.fixture
+def start_server(sonar_server):
+    """
+    Starts a server with a clean cache and the given sonar.conf options,
+    e.g. start_server(gapless=True). Stopped after the test.
+    """
+    servers = []
+
+    def start(**options):
+        from libsonar import ensure_paths
+        from variables import CACHE_DIR
+
+        write_config(**options)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        ensure_paths()
+
+        server = sonar_server.SonarServer(sonar_server.msg_queue)
+        thread = threading.Thread(target=server._start_server, daemon=True)
+        servers.append((server, thread))
+        thread.start()
+        wait_for(lambda: getattr(server, "socket_is_open", False))
+        return server
+
+    yield start
+
+    FakeConnection.gate = None
+    FakeConnection.delay = 0
+    for server, thread in servers:
+        # Wake the server loop up so it sees it has to stop.
+        server.socket_is_open = False
+        server.msg_queue.put("STOP")
+        thread.join(5)
+        server._stop_server()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for %s" % condition)
+        time.sleep(.005)
+
+
+@pytest.fixture
+def cached_songs():
+    """
+    Puts songs in the music cache, as if they had been downloaded.
+    """
+    def cache(*songs):
+        from variables import MUSIC_CACHE_DIR
+        os.makedirs(MUSIC_CACHE_DIR, exist_ok=True)
+        for s in songs:
+            path = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % s["id"])
+            with open(path, "wb") as f:
+                f.write(b"\0" * s["size"])
+    return cache
+
+
+def connect():
+    """
+    Opens a connection to the server's Unix socket.
+    """
+    from variables import SOCKET_FILE
+    sock = socket.socket(socket.AF_UNIX)
+    sock.settimeout(5)
+    sock.connect(SOCKET_FILE)
+    return sock
+
+
+def pipeline(sock, requests, handshake=True):
+    """
+    Sends the requests in one go, like the client does, and returns the
+    responses. The handshake goes first on a new connection.
+    """
+    from libsonar import protocol
+    buffers = [protocol.encode_handshake()] if handshake else []
+    for request in requests:
+        buffers.extend(protocol.encode_frame(request))
+    protocol.sendmsg_all(sock, buffers)
+    if handshake:
+        protocol.recv_handshake(sock)
+    return [protocol.recv_message(sock) for _ in requests]
@@ -0,0 +1,78 @@
+from libsonar.cache import CacheIndex
+
+
+def open_index(tmp_path, songs, limit=1 << 30):
+    for song_id, size in songs.items():
+        (tmp_path / ("%s.mp3" % song_id)).write_bytes(b"x" * size)
+    return CacheIndex(str(tmp_path), str(tmp_path / "index"), limit)
+
+
+def index_lines(tmp_path):
+    return (tmp_path / "index").read_text().splitlines()
+
+
+def test_index_is_replayed_from_the_log(tmp_path):
+    (tmp_path / "index").write_text(
+        "+ 1 100\n+ 2 200\n+ 3 300\n+ 4 400\n"
+        "- 2\n+ 1 100\n- 4\n+ 4 40\n"
+    )
+    index = open_index(tmp_path, {1: 100, 3: 300, 4: 40})
+
+    assert list(index.entries.items()) == [("3", 300), ("1", 100), ("4", 40)]
+    assert index.size == 440
+    assert "2" not in index
+    # The log matched the directory, so it was kept as it is.
+    assert index.log_lines == 8
+    index.close()
+
+
+def test_index_is_rebuilt_when_the_log_does_not_match(tmp_path):
+    (tmp_path / "index").write_text("+ 1 100\n")
+    index = open_index(tmp_path, {1: 100, 2: 200})
+
+    assert set(index.entries) == {"1", "2"}
+    assert index.size == 300
+    assert len(index_lines(tmp_path)) == 2
+    index.close()
+
+
+def test_log_is_compacted(tmp_path):
+    index = open_index(tmp_path, {1: 100, 2: 200})
+    for _ in range(1100):
+        index.touch(1)
+    index.touch(2)
+
+    # Every touch was logged, but the log is rewritten once it has grown
+    # well beyond the number of songs.
+    assert len(index_lines(tmp_path)) < 200
+    lines = index.log_lines
+    assert lines == len(index_lines(tmp_path))
+    index.close()
+
+    index = CacheIndex(str(tmp_path), str(tmp_path / "index"), 1 << 30)
+    assert list(index.entries.items()) == [("1", 100), ("2", 200)]
+    assert index.log_lines == lines
+    index.close()
+
+
+def test_eviction_order_survives_a_reopen(tmp_path):
+    index = open_index(tmp_path, {})
+    for song_id in (1, 2, 3, 4):
+        (tmp_path / ("%d.mp3" % song_id)).write_bytes(b"x" * 100)
+        index.add(song_id, 100)
+    index.touch(1)
+    index.touch(3)
+    index.remove(4)
+    index.close()
+
+    index = CacheIndex(str(tmp_path), str(tmp_path / "index"), 1 << 30)
+    assert index.size == 300
+    index.pin([2])
+    assert index.evict(100) == ["1", "3"]
+    assert list(index.entries) == ["2"]
+    assert not (tmp_path / "1.mp3").exists()
+    index.close()
+
+    index = CacheIndex(str(tmp_path), str(tmp_path / "index"), 1 << 30)
+    assert list(index.entries) == ["2"]
+    index.close()
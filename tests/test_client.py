@@ -0,0 +1,38 @@
+import os
+import shutil
+
+from conftest import song
+
+
+def cache_songs(count):
+    from libsonar import ensure_paths
+    from libsonar.tags import TagIndex
+    from variables import CACHE_DIR, MUSIC_CACHE_DIR, TAG_INDEX_FILE
+
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    ensure_paths()
+    tags = TagIndex(TAG_INDEX_FILE)
+    try:
+        for i in range(count):
+            s = song(1000 + i, track=i)
+            path = os.path.join(MUSIC_CACHE_DIR, "%s.mp3" % s["id"])
+            with open(path, "wb") as f:
+                f.write(b"\0" * s["size"])
+            tags.add(s, path)
+    finally:
+        tags.close()
+
+
+def test_cached_lists_all_songs_unless_paged(config, sonar_client):
+    config()
+    cache_songs(12)
+    client = sonar_client.SonarClient()
+    # What docopt hands over for `sonar.py cached`.
+    args = {"--limit": "10", "--page": None, "--sort": "artist"}
+
+    assert len(client.get_cached_songs(args)["song"]) == 12
+
+    args["--page"] = "1"
+    assert len(client.get_cached_songs(args)["song"]) == 2
+    args["--limit"] = "5"
+    assert len(client.get_cached_songs(args)["song"]) == 5
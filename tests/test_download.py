@@ -0,0 +1,109 @@
+import io
+import json
+
+from libsonar import open_stream
+from libsonar.download import Download
+
+SONG = bytes(range(256)) * 1024
+
+
+class Response(io.BytesIO):
+    """
+    What py-sonic hands back for a stream: the body, the status and the
+    headers.
+    """
+    def __init__(self, data, status=200, headers=None):
+        super(Response, self).__init__(data)
+        self.status = status
+        self.headers = headers or {}
+        self.length = len(data)
+
+
+class Request(object):
+    def __init__(self, view, query):
+        self.view = view
+        self.query = query
+        self.headers = {}
+
+    def add_header(self, name, value):
+        self.headers[name] = value
+
+
+class RangeConnection(object):
+    """
+    Stands in for a py-sonic Connection whose media server honours Range
+    headers, unless honour_range is False.
+    """
+    def __init__(self, honour_range=True):
+        self.honour_range = honour_range
+        self.requests = []
+
+    def stream(self, song_id):
+        return Response(SONG)
+
+    def _getRequest(self, view, query):
+        return Request(view, query)
+
+    def _doBinReq(self, request):
+        self.requests.append(request)
+        offset = int(request.headers["Range"][len("bytes="):-1])
+        if not self.honour_range:
+            return Response(SONG)
+        return Response(SONG[offset:], 206, {
+            "Content-Range": "bytes %d-%d/%d" % (
+                offset, len(SONG) - 1, len(SONG)
+            )
+        })
+
+    def _checkStatus(self, res):
+        raise Exception(res["error"])
+
+
+def interrupted_download(tmp_path, received):
+    path = str(tmp_path / "1.mp3")
+    with open("%s.part" % path, "wb") as f:
+        f.write(SONG[:received])
+    with open("%s.part.json" % path, "wt") as f:
+        json.dump({"size": len(SONG)}, f)
+    return Download("1", path, size=len(SONG))
+
+
+def test_interrupted_download_is_resumed(tmp_path):
+    download = interrupted_download(tmp_path, 1000)
+    connection = RangeConnection()
+
+    offset = download.resume_offset()
+    download.run(open_stream(connection, "1", offset), offset)
+
+    assert offset == 1000
+    request, = connection.requests
+    assert request.view == "stream.view"
+    assert request.query == {"id": "1"}
+    assert request.headers == {"Range": "bytes=1000-"}
+    with open(download.path, "rb") as f:
+        assert f.read() == SONG
+
+
+def test_download_starts_over_when_range_is_ignored(tmp_path):
+    download = interrupted_download(tmp_path, 1000)
+    connection = RangeConnection(honour_range=False)
+
+    offset = download.resume_offset()
+    download.run(open_stream(connection, "1", offset), offset)
+
+    assert connection.requests
+    with open(download.path, "rb") as f:
+        assert f.read() == SONG
+
+
+def test_download_starts_over_without_py_sonic_internals(tmp_path):
+    class Connection(object):
+        def stream(self, song_id):
+            return Response(SONG)
+
+    download = interrupted_download(tmp_path, 1000)
+    offset = download.resume_offset()
+    download.run(open_stream(Connection(), "1", offset), offset)
+
+    with open(download.path, "rb") as f:
+        assert f.read() == SONG
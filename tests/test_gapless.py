@@ -0,0 +1,54 @@
+import time
+
+from conftest import FakeConnection, song, wait_for
+
+# Longest the switch to the preloaded song may take, in seconds.
+GAP_BUDGET = .02
+
+
+def test_switch_to_preloaded_song_stays_within_gap_budget(
+        start_server, cached_songs):
+    # Integer ids, as many media servers send them.
+    songs = [song(701, track=1), song(702, track=2), song(703, track=3)]
+    FakeConnection.albums["gapless"] = songs
+
+    server = start_server(gapless=True)
+    cached_songs(*songs)
+    player = server.player
+
+    server._run(server.set_queue, {"album": [{"id": "gapless"}]})
+    server._run(server.play, 0)
+    wait_for(lambda: player.preloaded == "702")
+
+    active, standby = player.mplayer, player.standby
+    switched = len(standby.commands)
+    ended = time.perf_counter()
+    active.stdout.emit("EOF code: 1")
+
+    assert standby.resumed is not None
+    assert standby.resumed - ended < GAP_BUDGET
+
+    # The server catches up without touching the song that is playing.
+    wait_for(lambda: server.current_song == 1)
+    wait_for(lambda: player.preloaded == "703")
+    assert player.mplayer is standby
+    assert player.playing == "702"
+    assert [c[1] for c in standby.commands[switched:]] == ["pause"]
+
+
+def test_song_end_without_preloaded_song_plays_next_song(
+        start_server, cached_songs):
+    songs = [song(801, track=1), song(802, track=2)]
+    FakeConnection.albums["ungapless"] = songs
+
+    server = start_server(gapless=False)
+    cached_songs(*songs)
+    player = server.player
+
+    server._run(server.set_queue, {"album": [{"id": "ungapless"}]})
+    server._run(server.play, 0)
+    wait_for(lambda: player.playing == "801")
+
+    player.mplayer.stdout.emit("EOF code: 1")
+    wait_for(lambda: player.playing == "802")
+    assert server.current_song == 1
@@ -0,0 +1,16 @@
+import time
+
+from libsonar.metadata import MetadataCache, PLAYLIST_TTL
+
+
+def test_playlists_expire_before_the_ttl(tmp_path, monkeypatch):
+    cache = MetadataCache(str(tmp_path / "metadata.db"), ttl=86400)
+    for endpoint in ("getAlbum", "getPlaylist", "getPlaylists"):
+        cache.put(endpoint, "[]", {"endpoint": endpoint})
+    assert cache.get("getPlaylist", "[]") == {"endpoint": "getPlaylist"}
+
+    later = time.time() + PLAYLIST_TTL + 1
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert cache.get("getAlbum", "[]") == {"endpoint": "getAlbum"}
+    assert cache.get("getPlaylist", "[]") is None
+    assert cache.get("getPlaylists", "[]") is None
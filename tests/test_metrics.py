@@ -0,0 +1,83 @@
+import urllib.request
+
+from libsonar.metrics import Histogram, Metrics, serve
+
+from conftest import connect, pipeline
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram((1, 2, 4))
+    assert histogram.quantile(.5) is None
+
+    for value in (.5, 1, 3, 10):
+        histogram.observe(value)
+
+    # Buckets hold the values up to and including their bound.
+    assert histogram.counts == [2, 0, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 14.5
+    assert histogram.quantile(.5) == 1
+    assert histogram.quantile(.25) == .5
+    assert histogram.quantile(.75) == 4
+    # Above the last bucket.
+    assert histogram.quantile(.99) == 4
+
+
+def test_prometheus_text():
+    registry = Metrics()
+    registry.inc("sonar_requests_total", operation="status")
+    registry.inc("sonar_requests_total", 2, operation='say "hi"')
+    registry.observe("sonar_request_seconds", .003, operation="status")
+    registry.observe("sonar_request_seconds", 60, operation="status")
+    registry.gauge("sonar_queue_songs", lambda: 3)
+
+    lines = registry.prometheus().splitlines()
+    assert lines[:3] == [
+        "# TYPE sonar_requests_total counter",
+        'sonar_requests_total{operation="say \\"hi\\""} 2',
+        'sonar_requests_total{operation="status"} 1',
+    ]
+    assert lines[3] == "# TYPE sonar_request_seconds histogram"
+    assert 'sonar_request_seconds_bucket{operation="status",le="0.001"} 0' \
+        in lines
+    assert 'sonar_request_seconds_bucket{operation="status",le="0.005"} 1' \
+        in lines
+    assert 'sonar_request_seconds_bucket{operation="status",le="30"} 1' \
+        in lines
+    assert 'sonar_request_seconds_bucket{operation="status",le="+Inf"} 2' \
+        in lines
+    assert 'sonar_request_seconds_sum{operation="status"} 60.003' in lines
+    assert 'sonar_request_seconds_count{operation="status"} 2' in lines
+    assert lines[-2:] == [
+        "# TYPE sonar_queue_songs gauge",
+        "sonar_queue_songs 3"
+    ]
+
+    server = serve(0, registry)
+    try:
+        url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode("utf-8").splitlines() == lines
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_operation(start_server):
+    start_server()
+    with connect() as sock:
+        _, response = pipeline(sock, [
+            {"operation": "status"},
+            {"operation": "metrics"}
+        ])
+
+    assert response["code"] == "OK"
+    snapshot = response["metrics"]
+    assert snapshot["gauges"]["sonar_queue_songs"] == 0
+    histogram, = [
+        h for h in snapshot["histograms"]
+        if h["name"] == "sonar_request_seconds" and
+        h["labels"] == {"operation": "status"}
+    ]
+    assert histogram["count"] >= 1
+    assert 0 < histogram["p50"] <= histogram["p90"] <= histogram["p99"]
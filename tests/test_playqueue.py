@@ -0,0 +1,105 @@
+import random
+
+from libsonar.playqueue import PlayQueue, HISTORY_SIZE
+
+from conftest import song
+
+
+def test_views_match_the_queue_they_were_taken_of():
+    rng = random.Random(7)
+    queue = PlayQueue()
+    queue.extend([song(i) for i in range(50)])
+    views = []
+
+    for i in range(3 * HISTORY_SIZE):
+        edit = rng.random()
+        if edit < .4 or not len(queue):
+            queue.insert(rng.randrange(len(queue) + 1), [song(1000 + i)])
+        elif edit < .7:
+            queue.remove(rng.sample(range(len(queue)), min(3, len(queue))))
+        elif edit < .95:
+            queue.move(rng.randrange(len(queue)), rng.randrange(len(queue)))
+        else:
+            queue.shuffle(i)
+
+        view = queue.view()
+        views.append((view, queue.entry_ids(), queue.songs()))
+        if rng.random() < .1:
+            # A client reading the queue, which new views build on.
+            view.songs()
+
+    rng.shuffle(views)
+    for view, entry_ids, songs in views:
+        assert view.entry_ids() == entry_ids
+        assert view.songs() == songs
+        assert len(view) == len(songs)
+
+
+def test_history_only_returns_changes_it_still_has():
+    queue = PlayQueue()
+    queue.extend([song(i) for i in range(10)])
+    shuffled = queue.version
+    queue.shuffle(1)
+    start = queue.version
+    queue.move(0, 3)
+    queue.remove([2])
+    history = queue.history()
+
+    assert history.since(queue.version) == ()
+    assert [c[0] for c in history.since(start)] == ["move", "remove"]
+    assert [c[0] for c in history.since(start + 1)] == ["remove"]
+    # Unknown, newer than the queue or from before a shuffle.
+    assert history.since(None) is None
+    assert history.since(queue.version + 1) is None
+    assert history.since(shuffled) is None
+
+    for _ in range(HISTORY_SIZE):
+        queue.move(0, 1)
+    history = queue.history()
+    assert history.since(start) is None
+    assert len(history.since(queue.version - HISTORY_SIZE)) == HISTORY_SIZE
+
+
+def test_edits_do_not_copy_the_queue():
+    queue = PlayQueue()
+    queue.extend([song(i) for i in range(10000)])
+    first = queue.view()
+    first.songs()
+
+    queue.remove([100])
+    queue.move(0, 5)
+    view = queue.view()
+    assert view.entries is None
+    assert view.base is first
+    assert queue.view() is view
+    assert view.songs()[:6] == queue.songs()[:6]
+
+
+def test_moves_and_removes_keep_the_current_entry_known():
+    rng = random.Random(11)
+    queue = PlayQueue()
+    queue.extend([song(i) for i in range(200)])
+    model = list(queue.entry_ids())
+    queue.current_position = 100
+    current = queue.current
+    assert queue.current_position == 100
+
+    for i in range(500):
+        if rng.random() < .8:
+            source, destination = rng.randrange(len(model)), \
+                rng.randrange(len(model))
+            queue.move(source, destination)
+            model.insert(destination, model.pop(source))
+        else:
+            positions = [
+                p for p in rng.sample(range(len(model)), 2)
+                if model[p] != current
+            ]
+            queue.remove(positions)
+            for position in sorted(positions, reverse=True):
+                del model[position]
+
+        assert queue.order == model
+        # The current entry is found without scanning the queue.
+        assert queue.known == (current, model.index(current))
+        assert queue.current_position == model.index(current)
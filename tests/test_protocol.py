@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from libsonar import protocol
+
+
+def frame(message):
+    return b"".join(protocol.encode_frame(message))
+
+
+def test_frames_split_anywhere_are_put_back_together():
+    data = frame({"operation": "status"}) + frame({"operation": "pause"})
+    decoder = protocol.FrameDecoder()
+    messages = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        messages.extend(decoder)
+
+    assert messages == [{"operation": "status"}, {"operation": "pause"}]
+    assert not decoder.buffer
+
+
+def test_oversize_frame_is_refused_before_it_arrives(monkeypatch):
+    monkeypatch.setattr(protocol, "MAX_FRAME_SIZE", 16)
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.HEADER.pack(17))
+    with pytest.raises(protocol.ProtocolError):
+        list(decoder)
+    with pytest.raises(protocol.ProtocolError):
+        protocol.encode_frame({"operation": "x" * 16})
+
+
+def test_handshake():
+    data = protocol.encode_handshake()
+    assert protocol.is_framed(data[:1])
+    assert not protocol.is_framed(json.dumps({}).encode()[:1])
+    assert protocol.decode_handshake(data) == protocol.PROTOCOL_VERSION
+    assert protocol.negotiate_version(protocol.PROTOCOL_VERSION + 1) == \
+        protocol.PROTOCOL_VERSION
+
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_handshake(b"SNX\x01")
+    with pytest.raises(protocol.ProtocolError):
+        protocol.negotiate_version(0)
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import song
+from libsonar.results import read_results, write_results
+
+
+def search_results():
+    # Shaped like what the client caches after `sonar.py search`.
+    return {
+        "song": [song(1000 + i, album="Ålbum", track=i) for i in range(50)],
+        "album": [],
+        "current_song": 3,
+    }
+
+
+def test_search_results_are_read_back(tmp_path):
+    path = str(tmp_path / "results.cache")
+    expected = search_results()
+    write_results(path, expected)
+
+    results = read_results(path)
+    # Only lists are stored.
+    assert set(results) == {"song", "album"}
+    assert len(results["song"]) == 50
+    assert len(results["album"]) == 0
+    assert results["song"][3] == expected["song"][3]
+    assert results["song"][-1] == expected["song"][-1]
+    assert results["song"][10:13] == expected["song"][10:13]
+    assert list(results["song"]) == expected["song"]
+    with pytest.raises(IndexError):
+        results["song"][50]
+
+
+def test_store_replaced_while_mapped(tmp_path):
+    path = str(tmp_path / "results.cache")
+    write_results(path, search_results())
+    old = read_results(path)
+
+    write_results(path, {"artist": [{"id": "1", "name": "Artist"}]})
+
+    # The old mapping keeps the file it was opened on.
+    assert set(old) == {"song", "album"}
+    assert old["song"][0]["id"] == 1000
+    new = read_results(path)
+    assert set(new) == {"artist"}
+    assert new["artist"][0] == {"id": "1", "name": "Artist"}
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / "results.cache"
+    path.write_bytes(b"{}" * 16)
+    with pytest.raises(ValueError):
+        read_results(str(path))
@@ -0,0 +1,196 @@
+import json
+import threading
+
+from libsonar import protocol
+
+from conftest import FakeConnection, connect, pipeline, song, wait_for
+
+
+def recv_all(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_framed_requests_split_over_sends(start_server):
+    start_server()
+    data = protocol.encode_handshake() + b"".join(
+        protocol.encode_frame({"operation": "status"})
+    )
+    with connect() as sock:
+        for i in range(len(data)):
+            sock.send(data[i:i + 1])
+        assert protocol.recv_handshake(sock) == protocol.PROTOCOL_VERSION
+        assert protocol.recv_message(sock)["code"] == "OK"
+
+
+def test_bad_handshake_drops_the_client(start_server):
+    start_server()
+    with connect() as sock:
+        sock.sendall(b"SNX\x01")
+        assert recv_all(sock) == b""
+
+
+def test_legacy_client_gets_one_answer(start_server):
+    start_server()
+    with connect() as sock:
+        request = json.dumps({"operation": "status"}).encode()
+        sock.sendall(request[:5])
+        sock.sendall(request[5:])
+        assert json.loads(recv_all(sock))["code"] == "OK"
+
+
+def test_legacy_request_that_never_parses_is_dropped(
+        start_server, monkeypatch):
+    monkeypatch.setattr(protocol, "MAX_FRAME_SIZE", 1 << 16)
+    start_server()
+    with connect() as sock, connect() as other:
+        try:
+            for _ in range(4):
+                sock.sendall(b"{" + b"x" * (1 << 14) + b"}")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        assert recv_all(sock) == b""
+
+        # Nobody else had to wait for it.
+        response, = pipeline(other, [{"operation": "status"}])
+        assert response["code"] == "OK"
+
+
+def test_read_sees_the_changes_sent_before_it(start_server, cached_songs):
+    songs = [song(1201 + i, track=i) for i in range(4)]
+    FakeConnection.albums["pipelined"] = songs
+    server = start_server()
+    cached_songs(*songs)
+    # Keep the queue lookups from finishing before the read comes in.
+    gate = FakeConnection.gate = threading.Event()
+    threading.Timer(.1, gate.set).start()
+
+    with connect() as sock:
+        batch, status, shown = pipeline(sock, [
+            {"operation": "batch", "operations": [
+                {
+                    "operation": "set_queue",
+                    "data": {"album": [{"id": "pipelined"}]}
+                },
+                {"operation": "play", "queue_index": 2}
+            ]},
+            {"operation": "status"},
+            {"operation": "show_queue"}
+        ])
+
+        assert batch["code"] == "OK"
+        assert status["current_song"]["queue_position"] == 3
+        assert status["current_song"]["song"]["id"] == 1203
+        assert [s["id"] for s in shown["queue"]] == [s["id"] for s in songs]
+
+        shuffled, shown = pipeline(sock, [
+            {"operation": "batch", "operations": [
+                {"operation": "shuffle", "seed": 3}
+            ]},
+            {"operation": "show_queue"}
+        ], handshake=False)
+        wait_for(lambda: server.shuffle)
+        assert [s["id"] for s in shown["queue"]] == \
+            [s["id"] for s in server.queue.songs()]
+        assert shown["queue"][0]["id"] == 1203
+
+
+def test_insert_into_and_move_in_queue(start_server, cached_songs):
+    songs = [song(1301 + i, track=i) for i in range(3)]
+    FakeConnection.albums["editing"] = songs
+    FakeConnection.albums["inserted"] = [song(1311, album="inserted")]
+    start_server()
+
+    with connect() as sock:
+        responses = pipeline(sock, [
+            {
+                "operation": "set_queue",
+                "data": {"album": [{"id": "editing"}]}
+            },
+            {
+                "operation": "insert_into_queue",
+                "position": 1,
+                "data": {"album": [{"id": "inserted"}]}
+            },
+            {"operation": "move_in_queue", "source": 3, "destination": 0},
+            {"operation": "show_queue"}
+        ])
+
+    assert [r["code"] for r in responses] == ["OK"] * 4
+    assert [s["id"] for s in responses[-1]["queue"]] == \
+        [1303, 1301, 1311, 1302]
+
+
+def test_queue_changes_bring_a_client_up_to_date(
+        start_server, sonar_client):
+    from libsonar.playqueue import HISTORY_SIZE
+
+    FakeConnection.albums["catching up"] = [
+        song(1401 + i, track=i) for i in range(6)
+    ]
+    FakeConnection.albums["caught up"] = [
+        song(1411 + i, album="caught up", track=i) for i in range(2)
+    ]
+    server = start_server()
+    client = sonar_client.SonarClient()
+
+    def show_queue(cached):
+        return {
+            "operation": "show_queue",
+            "fields": client.queue_fields,
+            "queue_id": cached["queue_id"],
+            "queue_version": cached["queue_version"],
+            "cache_version": cached["cache_version"]
+        }
+
+    def assert_same_queue(cached):
+        assert cached["entries"] == list(server.queue.entry_ids())
+        assert [s["id"] for s in cached["songs"]] == \
+            [s["id"] for s in server.queue.songs()]
+
+    with connect() as sock:
+        _, shown = pipeline(sock, [
+            {
+                "operation": "set_queue",
+                "data": {"album": [{"id": "catching up"}]}
+            },
+            {"operation": "show_queue", "fields": client.queue_fields}
+        ])
+        cached = client._update_queue(None, shown)
+        assert_same_queue(cached)
+
+        responses = pipeline(sock, [
+            {
+                "operation": "insert_into_queue",
+                "position": 2,
+                "data": {"album": [{"id": "caught up"}]}
+            },
+            {"operation": "remove_from_queue", "data": [0, 4, 6]},
+            {"operation": "move_in_queue", "source": 3, "destination": 0},
+            {"operation": "move_in_queue", "source": 0, "destination": 4},
+            show_queue(cached)
+        ], handshake=False)
+        shown = responses[-1]
+        assert "queue" not in shown
+        assert [change[0] for change in shown["changes"]] == \
+            ["insert", "remove", "move", "move"]
+        cached = client._update_queue(cached, shown)
+        assert_same_queue(cached)
+        assert set(cached["songs"][0]) == set(client.queue_fields)
+
+        # Once the changes since the client's version are forgotten, the
+        # whole queue is sent again.
+        responses = pipeline(sock, [
+            {"operation": "move_in_queue", "source": 0, "destination": 1}
+            for _ in range(HISTORY_SIZE + 1)
+        ] + [show_queue(cached)], handshake=False)
+        shown = responses[-1]
+        assert "changes" not in shown
+        assert len(shown["queue"]) == len(server.queue)
+        cached = client._update_queue(cached, shown)
+        assert_same_queue(cached)
+        assert cached["queue_version"] == server.queue.version
@@ -0,0 +1,94 @@
+"""
+Startup of the client, which is run from hotkeys and statusbars. The hot
+commands are run in a fresh interpreter against a running server, like
+they are used.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from conftest import ROOT, FakeConnection, song, wait_for
+
+# Most the imports of a hot command may add up to, in seconds. Generous, as
+# it is the modules below that make the difference.
+IMPORT_BUDGET = .25
+
+# Most a hot command may take from start to exit, interpreter included, in
+# seconds.
+STARTUP_BUDGET = 1
+
+# Only needed by commands that talk to the media server or parse the whole
+# usage pattern.
+HEAVY_MODULES = (
+    "docopt",
+    "pysonic",
+    "readline",
+    "html.parser",
+    "http.client",
+    "urllib.request",
+    "sqlite3",
+    "subprocess",
+)
+
+# Imported to talk to the media server.
+MEDIA_SERVER_MODULES = (
+    "pysonic",
+    "libsonar.metadata",
+    "http.client",
+    "urllib.request",
+)
+
+
+def run_client(*argv):
+    """
+    Runs sonar.py with -X importtime. Returns the process and the modules
+    imported along with their own import times, in seconds.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(ROOT, "sonar.py")] +
+        list(argv),
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        timeout=30
+    )
+
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if own.strip().isdigit():
+            imports[name.strip()] = int(own) / 1e6
+    return process, imports
+
+
+def test_statusbar_stays_within_import_budget(start_server):
+    start_server()
+    process, imports = run_client("status", "-sb")
+
+    assert process.returncode == 0, process.stderr
+    assert not [m for m in HEAVY_MODULES if m in imports]
+    assert sum(imports.values()) < IMPORT_BUDGET
+
+
+def test_next_does_not_wait_for_the_media_server(start_server, cached_songs):
+    songs = [song(1101, track=1), song(1102, track=2)]
+    FakeConnection.albums["startup"] = songs
+    # Nothing answers there. Connecting would take until the timeout.
+    server = start_server(media_server="http://10.255.255.1")
+    cached_songs(*songs)
+    server._run(server.set_queue, {"album": [{"id": "startup"}]})
+    server._run(server.play, 0)
+    wait_for(lambda: server.player.playing == "1101")
+
+    start = time.perf_counter()
+    process, imports = run_client("next")
+    elapsed = time.perf_counter() - start
+
+    assert process.returncode == 0, process.stderr
+    assert not [m for m in MEDIA_SERVER_MODULES if m in imports]
+    assert elapsed < STARTUP_BUDGET
+    wait_for(lambda: server.player.playing == "1102")
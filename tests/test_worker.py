@@ -0,0 +1,129 @@
+import threading
+
+from libsonar.download import DownloadCancelled
+
+from conftest import FakeConnection, song, wait_for
+
+# Longest a command may wait for the worker while the media server is slow,
+# in seconds.
+COMMAND_BUDGET = .5
+
+
+def commands(player):
+    return [c[1] for c in player.commands]
+
+
+def test_pause_is_not_held_up_by_a_download(start_server):
+    songs = [song(901, track=1), song(902, track=2)]
+    FakeConnection.albums["downloads"] = songs
+    server = start_server()
+    server._run(server.set_queue, {"album": [{"id": "downloads"}]})
+    wait_for(lambda: len(server.snapshot["queue"]) == 2)
+
+    gate = FakeConnection.gate = threading.Event()
+    server._run(server.play, 0)
+    server._run(server.pause)
+    wait_for(
+        lambda: "pause" in commands(server.player.mplayer),
+        timeout=COMMAND_BUDGET
+    )
+    assert server.player.playing is None
+
+    gate.set()
+    wait_for(lambda: server.player.playing == "901")
+    assert commands(server.player.mplayer)[-2:] == ["loadfile", "pause"]
+
+
+def test_song_skipped_while_downloading_is_not_played(
+        start_server, cached_songs):
+    songs = [song(911, track=1), song(912, track=2)]
+    FakeConnection.albums["skipped"] = songs
+    server = start_server()
+    cached_songs(songs[1])
+    server._run(server.set_queue, {"album": [{"id": "skipped"}]})
+    wait_for(lambda: len(server.snapshot["queue"]) == 2)
+
+    gate = FakeConnection.gate = threading.Event()
+    server._run(server.play, 0)
+    server._run(server.play_next_song)
+    wait_for(lambda: server.player.playing == "912", timeout=COMMAND_BUDGET)
+
+    gate.set()
+    wait_for(lambda: not server.player.downloads)
+    # The worker is done with the download once a later command has run.
+    done = threading.Event()
+    server._run(done.set)
+    done.wait(5)
+    assert server.player.playing == "912"
+    assert server.current_song == 1
+
+
+def test_queue_is_built_off_the_worker(start_server, cached_songs):
+    songs = [song(921, track=1), song(922, track=2)]
+    FakeConnection.albums["built"] = songs
+    server = start_server()
+    cached_songs(*songs)
+
+    gate = FakeConnection.gate = threading.Event()
+    server._handle_request({
+        "operation": "batch",
+        "operations": [
+            {"operation": "set_queue", "data": {"album": [{"id": "built"}]}},
+            {"operation": "play", "queue_index": 1}
+        ]
+    })
+    server._run(server.pause)
+    wait_for(
+        lambda: "pause" in commands(server.player.mplayer),
+        timeout=COMMAND_BUDGET
+    )
+    assert len(server.snapshot["queue"]) == 0
+
+    # The rest of the batch waits for the queue.
+    gate.set()
+    wait_for(lambda: server.player.playing == "922")
+    assert server.current_song == 1
+
+
+def test_skipped_downloads_are_cancelled(start_server):
+    songs = [song(931 + i, track=i, size=1 << 20) for i in range(10)]
+    FakeConnection.albums["skipping"] = songs
+    FakeConnection.delay = .01
+    server = start_server()
+    server._run(server.set_queue, {"album": [{"id": "skipping"}]})
+    server._run(server.play, 0)
+    for _ in songs[1:]:
+        server._run(server.play_next_song)
+
+    claimed = []
+    done = threading.Event()
+
+    def check():
+        claimed.extend(
+            d.song_id for d in server.player.downloads.values() if d.claimed
+        )
+        done.set()
+
+    server._run(check)
+    done.wait(5)
+    assert claimed == ["940"]
+
+    wait_for(lambda: server.player.playing == "940")
+    wait_for(lambda: not server.player.downloads)
+    assert [s["id"] for s in songs if str(s["id"]) in server.cache] == [940]
+
+
+def test_downloads_stop_before_the_cache_closes(start_server):
+    songs = [song(951, size=1 << 20)]
+    FakeConnection.albums["stopping"] = songs
+    FakeConnection.delay = .01
+    server = start_server()
+    server._run(server.set_queue, {"album": [{"id": "stopping"}]})
+    server._run(server.play, 0)
+    wait_for(lambda: server.player.downloads)
+    download = server.player.downloads["951"]
+
+    server.player.quit()
+    assert download.done
+    assert isinstance(download.error, DownloadCancelled)
+    assert "951" not in server.cache
@@ -12,7 +12,13 @@ RUN_DIR = "%s/.local/run/sonar" % HOME_DIR
 
 # Files
 PID_FILE = "%s/sonar-server.pid" % RUN_DIR
+SOCKET_FILE = "%s/sonar-server.sock" % RUN_DIR
 CONFIG_FILE = "%s/sonar.conf" % CONFIG_DIR
+CACHE_INDEX_FILE = "%s/music_cache.index" % CACHE_DIR
+METADATA_CACHE_FILE = "%s/metadata.db" % CACHE_DIR
+SEARCH_INDEX_FILE = "%s/search.db" % CACHE_DIR
+TAG_INDEX_FILE = "%s/tags.db" % CACHE_DIR
+SYNC_STATE_FILE = "%s/sync.json" % CACHE_DIR
 SERVER_LOG_FILE = "%s/sonar-server.log" % LOG_DIR
 CLIENT_LOG_FILE = "%s/sonar-client.log" % LOG_DIR
 